@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+import glob
+import math
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import checkerlib
+
+
+RUN_DIR = os.environ.get('CHECKER_RUN_DIR', '/run/checker')
+LISTEN_ADDRESS = os.environ.get('CHECKER_EXPORTER_ADDRESS', '')
+LISTEN_PORT = int(os.environ.get('CHECKER_EXPORTER_PORT', '9469'))
+
+# Bytes of a run file read for its performance data
+OUTPUT_READ_MAX = 65536
+
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+TEXT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metric families in exposition order: name, type, help
+FAMILIES = [
+    ('checker_check_status', 'gauge',
+     'Exit code of the last check run (0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN)'),
+    ('checker_check_last_run_timestamp_seconds', 'gauge', 'End of the last check run'),
+    ('checker_check_duration_seconds', 'gauge', 'Duration of the last check run'),
+    ('checker_check_output_bytes', 'gauge', 'Size of the output of the last check run'),
+    ('checker_check_deferred_timestamp_seconds', 'gauge', 'Last time a check run was deferred by admission control'),
+    ('checker_check_unreachable_timestamp_seconds', 'gauge', 'Last time a check run was skipped for a CRITICAL parent'),
+    ('checker_perfdata_value', 'gauge', 'Performance data value reported by the check'),
+    ('checker_perfdata_warning', 'gauge', 'Warning threshold reported by the check'),
+    ('checker_perfdata_critical', 'gauge', 'Critical threshold reported by the check'),
+    ('checker_perfdata_min', 'gauge', 'Minimum value reported by the check'),
+    ('checker_perfdata_max', 'gauge', 'Maximum value reported by the check'),
+    ('checker_stage_duration_seconds', 'gauge', 'Wall time of a stage of the last run'),
+    ('checker_stage_cpu_seconds', 'gauge', 'CPU time of a stage of the last run'),
+]
+
+
+def escape(value):
+    """Escape a label value for the exposition format."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    """Format a sample value without losing precision, like timestamps in seconds."""
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer() and abs(value) < 2 ** 63:
+        return str(int(value))
+    return repr(value)
+
+
+def threshold(value):
+    """Plain numeric thresholds, ranges like 10:20 or @5 are not exported."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def check_samples(check_id, run_file):
+    """Build the samples of one check from its status header and run file.
+
+    Returns a dict of family name to sample lines, None if the check has
+    neither a status header nor a run file.
+    """
+    status = checkerlib.read_status(run_file)
+    try:
+        with open(run_file, 'r', errors='replace') as f:
+            output = f.read(OUTPUT_READ_MAX)
+            mtime = os.fstat(f.fileno()).st_mtime
+    except OSError:
+        if status is None:
+            return None
+        output, mtime = '', None
+
+    check = f'check="{escape(check_id)}"'
+    samples = {}
+
+    def add(family, labels, value):
+        if value is not None:
+            samples.setdefault(family, []).append(f'{family}{{{labels}}} {format_value(value)}\n')
+
+    def number(key):
+        try:
+            return float(status[key])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    if status is not None:
+        add('checker_check_status', check, number('Exit-Code'))
+        add('checker_check_last_run_timestamp_seconds', check, number('End'))
+        add('checker_check_duration_seconds', check, number('Duration'))
+        add('checker_check_output_bytes', check, number('Output-Bytes'))
+        add('checker_check_deferred_timestamp_seconds', check, number('Deferred'))
+        add('checker_check_unreachable_timestamp_seconds', check, number('Unreachable'))
+    else:
+        # Run files written by checker.sh have no status header
+        add('checker_check_last_run_timestamp_seconds', check, mtime)
+
+    for metric in checkerlib.parse_perfdata(output):
+        labels = f'{check},label="{escape(metric.label)}",uom="{escape(metric.uom)}"'
+        add('checker_perfdata_value', labels, metric.value)
+        add('checker_perfdata_warning', labels, threshold(metric.warn))
+        add('checker_perfdata_critical', labels, threshold(metric.crit))
+        add('checker_perfdata_min', labels, metric.min)
+        add('checker_perfdata_max', labels, metric.max)
+
+    for stage, values in checkerlib.read_timing(run_file).items():
+        labels = f'{check},stage="{escape(stage)}"'
+        add('checker_stage_duration_seconds', labels, values.get('wall_seconds'))
+        add('checker_stage_cpu_seconds', labels, values.get('cpu_seconds'))
+    return samples
+
+
+class Index:
+    """Samples of all checks, kept up to date from inotify events.
+
+    Scrapes are served from the rendered exposition, which the watcher
+    rebuilds once per batch of changes, so a scrape never renders itself.
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.checks = {}
+        self.lock = threading.Lock()
+        self.rendered = None
+
+    def update(self, check_id):
+        samples = check_samples(check_id, os.path.join(self.run_dir, f"{check_id}.out"))
+        with self.lock:
+            if samples is None:
+                self.checks.pop(check_id, None)
+            else:
+                self.checks[check_id] = samples
+            self.rendered = None
+
+    def rescan(self):
+        """Rebuild the index from all run files, after start or a queue overflow."""
+        check_ids = set()
+        for pattern in ('*.out', '*.status', '*.timing'):
+            for path in glob.glob(os.path.join(self.run_dir, pattern)):
+                check_ids.add(os.path.splitext(os.path.basename(path))[0])
+        checks = {}
+        for check_id in check_ids:
+            samples = check_samples(check_id, os.path.join(self.run_dir, f"{check_id}.out"))
+            if samples is not None:
+                checks[check_id] = samples
+        with self.lock:
+            self.checks = checks
+            self.rendered = None
+
+    def render(self):
+        """Exposition of all checks, grouped by metric family."""
+        with self.lock:
+            if self.rendered is None:
+                parts = []
+                check_ids = sorted(self.checks)
+                for family, metric_type, help_text in FAMILIES:
+                    parts.append(f"# TYPE {family} {metric_type}\n# HELP {family} {help_text}\n")
+                    for check_id in check_ids:
+                        parts.extend(self.checks[check_id].get(family, ()))
+                self.rendered = ''.join(parts).encode()
+            return self.rendered
+
+
+def make_handler(index):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = index.render()
+            if 'application/openmetrics-text' in self.headers.get('Accept', ''):
+                content_type, trailer = OPENMETRICS_TYPE, b'# EOF\n'
+            else:
+                content_type, trailer = TEXT_TYPE, b''
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body) + len(trailer)))
+            self.end_headers()
+            self.wfile.write(body)
+            self.wfile.write(trailer)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def watch(index, stop):
+    """Update the index for every status or run file changed in the run directory."""
+    inotify = checkerlib.Inotify()
+    inotify.add_watch(index.run_dir, checkerlib.Inotify.IN_CLOSE_WRITE
+                      | checkerlib.Inotify.IN_MOVED_TO | checkerlib.Inotify.IN_MOVED_FROM
+                      | checkerlib.Inotify.IN_DELETE | checkerlib.Inotify.IN_ONLYDIR)
+    # Files changed before the watch was added are picked up by the scan
+    index.rescan()
+    index.render()
+    print(f"Indexed {len(index.checks)} checks from {index.run_dir}")
+    try:
+        while not stop.is_set():
+            changed = set()
+            for _, mask, name in inotify.read(timeout=1):
+                if mask & checkerlib.Inotify.IN_Q_OVERFLOW:
+                    index.rescan()
+                    changed.clear()
+                    break
+                base, ext = os.path.splitext(name)
+                if ext in ('.out', '.status', '.timing'):
+                    changed.add(base)
+            for check_id in changed:
+                index.update(check_id)
+            index.render()
+    finally:
+        inotify.close()
+
+
+def main():
+    os.makedirs(RUN_DIR, exist_ok=True)
+    index = Index(RUN_DIR)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    server = ThreadingHTTPServer((LISTEN_ADDRESS, LISTEN_PORT), make_handler(index))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving check metrics on {LISTEN_ADDRESS or '*'}:{LISTEN_PORT}/metrics")
+
+    try:
+        watch(index, stop)
+    except OSError as e:
+        print(f"Error watching {RUN_DIR}: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,32 @@ import sys
 import subprocess
 import time
 import glob
+import socket
+import argparse
 from datetime import datetime
 
+# Shared helpers installed by the checker role
+sys.path.insert(0, os.environ.get('CHECKER_LIB_DIR', '/etc/checker'))
+import checkerlib
+
+
+CHECKS_DIR = os.environ.get('CHECKER_CHECKS_DIR', '/etc/checker/checks')
+RUN_DIR = os.environ.get('CHECKER_RUN_DIR', '/run/checker')
+CGROUP_ROOT = '/sys/fs/cgroup'
+CHECKER_CGROUPS = [
+    'system.slice/system-checker.slice/checker@*.service',
+    'system.slice/checker-*.service',
+]
+
+# Unit properties fetched for all loaded units with a single systemctl call
+UNIT_PROPERTIES = [
+    'Id', 'Description', 'LoadState', 'ActiveState', 'SubState',
+    'MemoryCurrent', 'NextElapseUSecRealtime', 'LastTriggerUSec', 'Triggers',
+]
+UNITS_CACHE_TTL = 5
+
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
 
 # Colors
 class Colors:
@@ -25,7 +49,9 @@ def get_status_color(exit_code):
         0: f"{Colors.GREEN}OK{Colors.NC}",
         1: f"{Colors.YELLOW}WARNING{Colors.NC}",
         2: f"{Colors.RED}CRITICAL{Colors.NC}",
-        3: f"{Colors.BLUE}UNKNOWN{Colors.NC}"
+        3: f"{Colors.BLUE}UNKNOWN{Colors.NC}",
+        checkerlib.DEFERRED_EXIT_CODE: f"{Colors.BLUE}DEFERRED{Colors.NC}",
+        checkerlib.UNREACHABLE_EXIT_CODE: f"{Colors.BLUE}UNREACHABLE{Colors.NC}",
     }
     return status_map.get(exit_code, f"{Colors.BLUE}UNKNOWN{Colors.NC}")
 
@@ -39,19 +65,103 @@ def run_command(cmd, default=""):
         return default
 
 
+def read_file(path, default=""):
+    """Read a small file from /proc or /sys."""
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return default
+
+
+def read_file_bytes(path):
+    """Read a small binary file, empty if it vanished."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return b""
+
+
+def format_size(size, suffix):
+    """Format a byte count the way free -h and df -h do."""
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+    if unit == 'B':
+        return f"{size:.0f}B"
+    return f"{size:.1f}{unit}{suffix}" if size < 10 else f"{size:.0f}{unit}{suffix}"
+
+
+def format_uptime(seconds):
+    """Format seconds like uptime -p."""
+    minutes = int(seconds) // 60
+    parts = []
+    for name, length in (('week', 10080), ('day', 1440), ('hour', 60), ('minute', 1)):
+        count, minutes = divmod(minutes, length)
+        if count:
+            parts.append(f"{count} {name}{'s' if count != 1 else ''}")
+    return "up " + (', '.join(parts) if parts else "0 minutes")
+
+
+def read_meminfo():
+    """Read /proc/meminfo into a dict of byte counts."""
+    meminfo = {}
+    for line in read_file('/proc/meminfo').splitlines():
+        key, _, value = line.partition(':')
+        fields = value.split()
+        if fields:
+            meminfo[key] = int(fields[0]) * 1024
+    return meminfo
+
+
+def count_processes():
+    """Count all processes and those running checker from /proc."""
+    total = checker = 0
+    own_pid = str(os.getpid())
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or pid == own_pid:
+            continue
+        total += 1
+        if b'checker' in read_file_bytes(f'/proc/{pid}/cmdline'):
+            checker += 1
+    return total, checker
+
+
+_hostname = None
+
+
 def get_system_resources():
     """Get system resource information."""
-    hostname = run_command("hostname -f")
-    uptime = run_command("uptime -p")
-    load_avg = run_command("uptime | awk -F'load average:' '{print $2}'")
-    memory = run_command("free -h | awk '/^Mem:/ {print $3 \" / \" $2 \" (\" int($3/$2 * 100) \"%)\"}'")
-    disk = run_command("df -h / | awk 'NR==2 {print $3 \" / \" $2 \" (\" $5 \")\"}'")
-    total_procs = run_command("ps aux | wc -l")
-    checker_procs = run_command("ps aux | grep -c checker || echo 0")
+    global _hostname
+    if _hostname is None:
+        _hostname = socket.getfqdn()
+    
+    uptime = read_file('/proc/uptime', "0").split()[0]
+    load_avg = ', '.join(read_file('/proc/loadavg', "0 0 0").split()[:3])
+    
+    meminfo = read_meminfo()
+    mem_total = meminfo.get('MemTotal', 0)
+    mem_used = mem_total - meminfo.get('MemAvailable', meminfo.get('MemFree', 0))
+    mem_percent = mem_used * 100 // mem_total if mem_total else 0
+    memory = f"{format_size(mem_used, 'i')} / {format_size(mem_total, 'i')} ({mem_percent}%)"
+    
+    try:
+        fs = os.statvfs('/')
+        disk_total = fs.f_blocks * fs.f_frsize
+        disk_used = (fs.f_blocks - fs.f_bfree) * fs.f_frsize
+        disk_avail = fs.f_bavail * fs.f_frsize
+        disk_percent = -(-disk_used * 100 // (disk_used + disk_avail)) if disk_used + disk_avail else 0
+        disk = f"{format_size(disk_used, '')} / {format_size(disk_total, '')} ({disk_percent}%)"
+    except OSError:
+        disk = ""
+    
+    total_procs, checker_procs = count_processes()
     
     return {
-        'hostname': hostname,
-        'uptime': uptime,
+        'hostname': _hostname,
+        'uptime': format_uptime(float(uptime)),
         'load_avg': load_avg,
         'memory': memory,
         'disk': disk,
@@ -60,82 +170,136 @@ def get_system_resources():
     }
 
 
+_units_cache = (0, [])
+
+
+def get_units():
+    """Get the properties of all loaded units, cached between refreshes."""
+    global _units_cache
+    if time.monotonic() - _units_cache[0] < UNITS_CACHE_TTL:
+        return _units_cache[1]
+    
+    output = run_command(f"systemctl show --no-pager -p {','.join(UNIT_PROPERTIES)} '*'")
+    units = []
+    for block in output.split('\n\n'):
+        unit = {}
+        for line in block.splitlines():
+            key, _, value = line.partition('=')
+            unit[key] = value
+        if unit.get('Id'):
+            units.append(unit)
+    
+    _units_cache = (time.monotonic(), units)
+    return units
+
+
+def is_listed(unit):
+    """Whether systemctl list-units would show the unit by default."""
+    return unit.get('ActiveState') != 'inactive' and unit.get('LoadState') != 'not-found'
+
+
+def is_checker_unit(unit):
+    """Whether the unit belongs to checker."""
+    return unit['Id'].startswith(('checker@', 'checker-'))
+
+
 def get_systemd_summary():
     """Get systemd units summary."""
-    cmd = "systemctl list-units --no-pager --no-legend | awk '{print $4}' | sort | uniq -c"
-    output = run_command(cmd)
-    if output:
-        lines = output.split('\n')
-        summary = []
-        for line in lines:
-            parts = line.strip().split()
-            if len(parts) == 2:
-                summary.append(f"  {parts[1]:<12} {parts[0]}")
-        return '\n'.join(summary)
+    counts = {}
+    for unit in get_units():
+        if is_listed(unit):
+            counts[unit['SubState']] = counts.get(unit['SubState'], 0) + 1
+    if counts:
+        return '\n'.join(f"  {state:<12} {count}" for state, count in sorted(counts.items()))
     return "  No units found"
 
 
 def get_failed_units():
     """Get failed systemd units."""
-    count = run_command("systemctl list-units --failed --no-pager --no-legend | wc -l", "0")
-    if int(count) > 0:
-        units = run_command("systemctl list-units --failed --no-pager")
+    failed = [unit for unit in get_units() if unit.get('ActiveState') == 'failed']
+    if failed:
+        units = '\n'.join(
+            f"  {unit['Id']:<40} {unit['LoadState']:<8} {unit['ActiveState']:<8} "
+            f"{unit['SubState']:<8} {unit.get('Description', '')}"
+            for unit in failed
+        )
         return f"{Colors.RED}Failed SystemD Units:{Colors.NC}\n{units}"
     return None
 
 
 def get_checker_timers():
     """Get checker timers status."""
-    timers = run_command("systemctl list-timers 'checker-*' --no-pager --no-legend")
+    timers = []
+    for unit in get_units():
+        if unit['Id'].endswith('.timer') and is_checker_unit(unit) and unit.get('ActiveState') == 'active':
+            next_run = unit.get('NextElapseUSecRealtime') or 'n/a'
+            last_run = unit.get('LastTriggerUSec') or 'n/a'
+            timers.append(f"  {unit['Id']:<40} next {next_run:<28} last {last_run:<28} {unit.get('Triggers', '')}")
     if timers:
-        return '\n'.join(f"  {line}" for line in timers.split('\n'))
+        return '\n'.join(timers)
     return "  No active checker timers"
 
 
-def get_checker_status():
-    """Get checker check results."""
-    checks = []
+def get_check_row(check_name):
+    """Get the status row of a single check."""
+    run_file = os.path.join(RUN_DIR, f"{check_name}.out")
+    try:
+        # Only the first line of the output is shown
+        with open(run_file, 'r', errors='replace') as f:
+            first_line = f.readline(256).rstrip('\n') or "No output"
+    except FileNotFoundError:
+        return (check_name, get_status_color(3), "Never", "Not run yet")
+    except Exception:
+        return (check_name, get_status_color(3), "Error", "Failed to read")
     
-    for check_dir in glob.glob('/etc/checker/checks/*/'):
-        if os.path.isdir(check_dir):
-            check_name = os.path.basename(check_dir.rstrip('/'))
-            run_file = f"/run/checker/{check_name}.out"
-            
-            if os.path.exists(run_file):
-                try:
-                    with open(run_file, 'r') as f:
-                        content = f.read()
-                    
-                    # Extract metadata
-                    exit_code = 3
-                    last_run = "Never"
-                    for line in content.split('\n'):
-                        if line.startswith('Exit-Code:'):
-                            exit_code = int(line.split()[1])
-                        elif line.startswith('Last-Run:'):
-                            timestamp = line.split()[1]
-                            # Extract time part
-                            if 'T' in timestamp:
-                                last_run = timestamp.split('T')[1].split('+')[0]
-                    
-                    # Get first line of output
-                    first_line = content.split('\n')[0] if content else "No output"
-                    output = first_line[:35]
-                    if len(first_line) > 35:
-                        output += "..."
-                    
-                    status = get_status_color(exit_code)
-                    checks.append((check_name, status, last_run, output))
-                except Exception:
-                    checks.append((check_name, get_status_color(3), "Error", "Failed to read"))
-            else:
-                checks.append((check_name, get_status_color(3), "Never", "Not run yet"))
+    try:
+        # Exit code and run time come from the status header
+        exit_code = 3
+        last_run = "Never"
+        status = checkerlib.read_status(run_file)
+        if status and float(status.get('Deferred', 0)) > float(status.get('End', 0)):
+            # The last run was deferred by admission control
+            exit_code = checkerlib.DEFERRED_EXIT_CODE
+            last_run = datetime.fromtimestamp(float(status['Deferred'])).strftime('%H:%M:%S')
+            first_line = status.get('Deferred-Reason', first_line)
+        elif status and float(status.get('Unreachable', 0)) > float(status.get('End', 0)):
+            # The last run was skipped as a CHECK_DEPENDS parent is CRITICAL
+            exit_code = checkerlib.UNREACHABLE_EXIT_CODE
+            last_run = datetime.fromtimestamp(float(status['Unreachable'])).strftime('%H:%M:%S')
+            first_line = f"{status.get('Unreachable-Root', 'Parent')} is CRITICAL"
+        elif status:
+            exit_code = int(status.get('Exit-Code', 3))
+            last_run = datetime.fromtimestamp(float(status['End'])).strftime('%H:%M:%S')
+    except Exception:
+        return (check_name, get_status_color(3), "Error", "Failed to read")
     
-    return checks
+    output = first_line[:35]
+    if len(first_line) > 35:
+        output += "..."
+    return (check_name, get_status_color(exit_code), last_run, output)
+
+
+def list_checks():
+    """Names of all check directories."""
+    registry = checkerlib.read_registry()
+    if registry and registry.fresh(CHECKS_DIR):
+        return registry.check_ids()
+    return [os.path.basename(check_dir.rstrip('/'))
+            for check_dir in glob.glob(os.path.join(CHECKS_DIR, '*/'))]
+
+
+def state_name(exit_code):
+    return STATE_NAMES[exit_code] if 0 <= exit_code < len(STATE_NAMES) else f"EXIT {exit_code}"
 
 
 def get_recent_activity():
-    """Get recent checker activity from journal."""
+    """Get recent check results from the history log, or the journal without one."""
+    recent = checkerlib.History().recent(5)
+    if recent:
+        return '\n'.join(
+            f"  {datetime.fromtimestamp(end).strftime('%H:%M:%S')} {check_id:<20} "
+            f"{state_name(exit_code):<9} {duration:.2f}s"
+            for check_id, end, duration, exit_code, _ in recent)
     cmd = "journalctl -u 'checker-*.service' --since '5 minutes ago' --no-pager | tail -n 5"
     output = run_command(cmd)
     if output:
@@ -145,107 +309,320 @@ def get_recent_activity():
 
 
 def get_resource_usage():
-    """Get resource usage by checker services."""
+    """Get resource usage by checker services from their cgroups."""
     usage = []
-    services = run_command("systemctl list-units 'checker-*.service' --no-legend | awk '{print $1}'")
-    
-    if services:
-        for service in services.split('\n'):
-            if service.strip():
-                active = run_command(f"systemctl is-active {service}")
-                if active == "active":
-                    mem = run_command(f"systemctl show {service} -p MemoryCurrent | cut -d= -f2")
-                    if mem and mem != "[not set]" and mem != "18446744073709551615":
-                        try:
-                            mem_mb = int(mem) // 1024 // 1024
-                            usage.append(f"  {service}: {mem_mb}MB")
-                        except ValueError:
-                            pass
+    
+    for pattern in CHECKER_CGROUPS:
+        for cgroup in sorted(glob.glob(os.path.join(CGROUP_ROOT, pattern))):
+            mem = read_file(os.path.join(cgroup, 'memory.current')).strip()
+            if not mem.isdigit():
+                continue
+            cpu_usec = 0
+            for line in read_file(os.path.join(cgroup, 'cpu.stat')).splitlines():
+                if line.startswith('usage_usec '):
+                    cpu_usec = int(line.split()[1])
+            mem_mb = int(mem) // 1024 // 1024
+            usage.append(f"  {os.path.basename(cgroup)}: {mem_mb}MB, CPU {cpu_usec / 1e6:.2f}s")
+    
+    # Without cgroup v2 fall back to the memory accounting systemd reports
+    if not usage:
+        for unit in get_units():
+            mem = unit.get('MemoryCurrent', '')
+            if (unit['Id'].endswith('.service') and is_checker_unit(unit)
+                    and unit.get('ActiveState') == 'active' and mem.isdigit()
+                    and mem != "18446744073709551615"):
+                usage.append(f"  {unit['Id']}: {int(mem) // 1024 // 1024}MB")
     
     return '\n'.join(usage) if usage else "  No active checker services"
 
 
-def clear_screen():
-    """Clear the terminal screen."""
-    os.system('clear' if os.name == 'posix' else 'cls')
+class Screen:
+    """Terminal redrawn in place, rewriting only the lines that changed."""
+    
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.lines = []
+        self.size = None
+    
+    def draw(self, lines):
+        size = os.get_terminal_size(self.stream.fileno()) if self.stream.isatty() else None
+        if size != self.size:
+            # Start over after the terminal was resized
+            self.size = size
+            self.lines = []
+            self.stream.write("\033[H\033[2J")
+        if size:
+            lines = lines[:size.lines - 1]
+        
+        out = ["\033[?25l"]
+        for row, line in enumerate(lines):
+            if row >= len(self.lines) or self.lines[row] != line:
+                out.append(f"\033[{row + 1};1H{line}\033[K")
+        if len(lines) < len(self.lines):
+            out.append(f"\033[{len(lines) + 1};1H\033[J")
+        out.append(f"\033[{len(lines) + 1};1H")
+        self.stream.write(''.join(out))
+        self.stream.flush()
+        self.lines = lines
+    
+    def close(self):
+        self.stream.write("\033[?25h")
+        self.stream.flush()
+
+
+def get_system_sections():
+    """Sections backed by /proc, systemctl and the journal, refreshed periodically."""
+    resources = get_system_resources()
+    sections = [
+        "System Resources:",
+        "----------------",
+        f"  Hostname: {resources['hostname']}",
+        f"  Uptime: {resources['uptime']}",
+        f"  Load Average: {resources['load_avg']}",
+        f"  Memory: {resources['memory']}",
+        f"  Disk /: {resources['disk']}",
+        f"  Processes: {resources['total_procs']} total, {resources['checker_procs']} checker",
+        "",
+        "SystemD Units Summary:",
+        "---------------------",
+        get_systemd_summary(),
+        "",
+    ]
+    
+    failed = get_failed_units()
+    if failed:
+        sections += [failed, ""]
+    
+    sections += [
+        "Checker Timers:",
+        "---------------",
+        get_checker_timers(),
+        "",
+    ]
+    activity = [
+        "Recent Checker Activity:",
+        "-----------------------",
+        get_recent_activity(),
+        "",
+        "Checker Resource Usage:",
+        "----------------------",
+        get_resource_usage(),
+        "",
+    ]
+    return sections, activity
+
+
+def build_screen(checks, system, refresh):
+    """All lines of the dashboard."""
+    sections, activity = system
+    lines = [
+        "==========================================",
+        "      SYSTEMD & CHECKER MONITOR",
+        "==========================================",
+        f"Time: {datetime.now().strftime('%c')}",
+        "",
+    ]
+    lines += sections
+    lines += [
+        "Checker Status:",
+        "---------------",
+        f"{'CHECK':<20} {'STATUS':<10} {'LAST RUN':<15} OUTPUT",
+        "-" * 70,
+    ]
+    for check_name in sorted(checks):
+        check_name, status, last_run, output = checks[check_name]
+        lines.append(f"{check_name:<20} {status:<18} {last_run:<15} {output}")
+    lines.append("")
+    lines += activity
+    lines += [
+        "==========================================",
+        f"Press Ctrl+C to exit. Auto-refresh in {refresh:g}s",
+        "==========================================",
+    ]
+    # Multi-line sections become separate screen lines
+    return '\n'.join(lines).split('\n')
+
+
+def watch_checks():
+    """Watch the run and checks directories, None if inotify is unavailable."""
+    try:
+        inotify = checkerlib.Inotify()
+        runs = inotify.add_watch(RUN_DIR, checkerlib.Inotify.IN_CLOSE_WRITE
+                                 | checkerlib.Inotify.IN_MOVED_TO | checkerlib.Inotify.IN_MOVED_FROM
+                                 | checkerlib.Inotify.IN_DELETE | checkerlib.Inotify.IN_ONLYDIR)
+        inotify.add_watch(CHECKS_DIR, checkerlib.Inotify.IN_CREATE | checkerlib.Inotify.IN_DELETE
+                          | checkerlib.Inotify.IN_MOVED_TO | checkerlib.Inotify.IN_MOVED_FROM
+                          | checkerlib.Inotify.IN_ONLYDIR)
+    except OSError:
+        return None, None
+    return inotify, runs
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def format_span(seconds):
+    """Format seconds in the two largest units, like 2d 3h or 5m 10s."""
+    seconds = int(seconds)
+    parts = []
+    for name, length in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        count, seconds = divmod(seconds, length)
+        if count or parts:
+            parts.append(f"{count}{name}")
+    return ' '.join(parts[:2]) or '0s'
+
+
+def history_recent(history, args):
+    print(f"{'TIME':<19}  {'CHECK':<30} {'STATE':<9} DURATION")
+    for check_id, end, duration, exit_code, flags in history.recent(args.limit):
+        cached = ' (cached)' if flags & checkerlib.History.FLAG_CACHED else ''
+        print(f"{format_time(end):<19}  {check_id:<30} {state_name(exit_code):<9} {duration:.3f}s{cached}")
+
+
+def history_check(history, args):
+    """State changes of one check with the time spent in each state."""
+    records = history.records(args.check_id, time.time() - args.since)
+    if not records:
+        print(f"No history of {args.check_id}")
+        return 1
+
+    print(f"{'SINCE':<19}  {'STATE':<9} {'FOR':<8} RUNS")
+    changes = []
+    for end, duration, exit_code, _ in records:
+        if args.all or not changes or changes[-1][1] != exit_code:
+            changes.append([end, exit_code, 0])
+        changes[-1][2] += 1
+    for index, (start, exit_code, runs) in enumerate(changes):
+        until = changes[index + 1][0] if index + 1 < len(changes) else time.time()
+        print(f"{format_time(start):<19}  {state_name(exit_code):<9} {format_span(until - start):<8} {runs}")
+
+    durations = [duration for _, duration, _, _ in records]
+    state_changes = sum(1 for previous, record in zip(records, records[1:]) if previous[2] != record[2])
+    print(f"\n{len(records)} runs, {state_changes} state changes, "
+          f"duration avg {sum(durations) / len(durations):.3f}s max {max(durations):.3f}s")
+    return 0
+
+
+def history_slowest(history, args):
+    summaries = history.summaries(time.time() - args.since)
+    print(f"{'CHECK':<30} {'AVG':>8} {'MAX':>8}  {'SLOWEST RUN':<19} RUNS")
+    for check_id, summary in sorted(summaries.items(), key=lambda item: -item[1]['max_duration'])[:args.limit]:
+        print(f"{check_id:<30} {summary['total_duration'] / summary['runs']:>7.3f}s "
+              f"{summary['max_duration']:>7.3f}s  {format_time(summary['max_end']):<19} {summary['runs']}")
+
+
+def history_flapping(history, args):
+    """Checks changing their state in more than threshold percent of their runs."""
+    summaries = history.summaries(time.time() - args.since)
+    flapping = []
+    for check_id, summary in summaries.items():
+        change = 100 * summary['changes'] / max(summary['runs'] - 1, 1)
+        if change >= args.threshold:
+            flapping.append((change, check_id, summary))
+    print(f"{'CHECK':<30} {'CHANGE':>7} {'CHANGES':>8} RUNS")
+    for change, check_id, summary in sorted(flapping, reverse=True)[:args.limit]:
+        print(f"{check_id:<30} {change:>6.1f}% {summary['changes']:>8} {summary['runs']}")
+
+
+def history_states(history, args):
+    """Share of time each check spent in each state."""
+    summaries = history.summaries(time.time() - args.since)
+    print(f"{'CHECK':<30} " + ' '.join(f"{name:>9}" for name in STATE_NAMES) + "  NOW")
+    for check_id, summary in sorted(summaries.items()):
+        total = sum(summary['state_seconds']) or 1
+        print(f"{check_id:<30} " + ' '.join(f"{100 * seconds / total:>8.1f}%" for seconds in summary['state_seconds'])
+              + f"  {state_name(summary['exit_code'])}")
+
+
+def history(argv):
+    """Query the history log, checker-monitor history <command>."""
+    def since(value):
+        units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+        try:
+            return float(value[:-1]) * units[value[-1]] if value[-1] in units else float(value)
+        except (ValueError, IndexError):
+            raise argparse.ArgumentTypeError(f"invalid time span: {value}")
+
+    parser = argparse.ArgumentParser(prog='checker-monitor history', description="Query the check result history")
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('recent', help="Latest results of all checks")
+    command.add_argument('-n', '--limit', type=int, default=20)
+    command.set_defaults(func=history_recent)
+    command = commands.add_parser('check', help="State changes of one check")
+    command.add_argument('check_id')
+    command.add_argument('--since', type=since, default='1d', help="Time span like 12h or 7d (default: 1d)")
+    command.add_argument('-a', '--all', action='store_true', help="List every run instead of state changes")
+    command.set_defaults(func=history_check)
+    command = commands.add_parser('slowest', help="Checks with the slowest runs")
+    command.add_argument('--since', type=since, default='7d', help="Time span like 12h or 7d (default: 7d)")
+    command.add_argument('-n', '--limit', type=int, default=10)
+    command.set_defaults(func=history_slowest)
+    command = commands.add_parser('flapping', help="Checks changing their state often")
+    command.add_argument('--since', type=since, default='1d', help="Time span like 12h or 7d (default: 1d)")
+    command.add_argument('--threshold', type=float, default=20,
+                         help="Percent of runs changing the state (default: 20)")
+    command.add_argument('-n', '--limit', type=int, default=10)
+    command.set_defaults(func=history_flapping)
+    command = commands.add_parser('states', help="Time spent in each state per check")
+    command.add_argument('--since', type=since, default='7d', help="Time span like 12h or 7d (default: 7d)")
+    command.set_defaults(func=history_states)
+
+    args = parser.parse_args(argv)
+    return args.func(checkerlib.History(), args) or 0
 
 
 def main():
-    """Main monitoring loop."""
+    """Main monitoring loop.
+    
+    Check rows are updated as soon as inotify reports a finished run or an
+    added or removed check directory, the system sections every refresh
+    interval.
+    """
+    if sys.argv[1:2] == ['history']:
+        sys.exit(history(sys.argv[2:]))
+
+    refresh = float(os.environ.get('CHECKER_MONITOR_REFRESH', '10'))
+    screen = Screen()
+    inotify, runs = watch_checks()
+    checks = {check_name: get_check_row(check_name) for check_name in list_checks()}
+    system = get_system_sections()
+    next_refresh = time.monotonic() + refresh
+    
     try:
         while True:
-            clear_screen()
-            
-            print("==========================================")
-            print("      SYSTEMD & CHECKER MONITOR")
-            print("==========================================")
-            print(f"Time: {datetime.now().strftime('%c')}")
-            print()
-            
-            # System resources
-            resources = get_system_resources()
-            print("System Resources:")
-            print("----------------")
-            print(f"  Hostname: {resources['hostname']}")
-            print(f"  Uptime: {resources['uptime']}")
-            print(f"  Load Average: {resources['load_avg']}")
-            print(f"  Memory: {resources['memory']}")
-            print(f"  Disk /: {resources['disk']}")
-            print(f"  Processes: {resources['total_procs']} total, {resources['checker_procs']} checker")
-            print()
-            
-            # SystemD units summary
-            print("SystemD Units Summary:")
-            print("---------------------")
-            print(get_systemd_summary())
-            print()
-            
-            # Failed units
-            failed = get_failed_units()
-            if failed:
-                print(failed)
-                print()
-            
-            # Checker timers
-            print("Checker Timers:")
-            print("---------------")
-            print(get_checker_timers())
-            print()
+            screen.draw(build_screen(checks, system, refresh))
             
-            # Checker status
-            print("Checker Status:")
-            print("---------------")
-            print(f"{'CHECK':<20} {'STATUS':<10} {'LAST RUN':<15} OUTPUT")
-            print("-" * 70)
-            
-            checks = get_checker_status()
-            for check_name, status, last_run, output in checks:
-                print(f"{check_name:<20} {status:<18} {last_run:<15} {output}")
-            print()
-            
-            # Recent activity
-            print("Recent Checker Activity:")
-            print("-----------------------")
-            print(get_recent_activity())
-            print()
-            
-            # Resource usage
-            print("Checker Resource Usage:")
-            print("----------------------")
-            print(get_resource_usage())
-            print()
-            
-            # Refresh instruction
-            print("==========================================")
-            print("Press Ctrl+C to exit. Auto-refresh in 10s")
-            print("==========================================")
+            timeout = max(next_refresh - time.monotonic(), 0)
+            if inotify is None:
+                time.sleep(timeout)
+                checks = {check_name: get_check_row(check_name) for check_name in list_checks()}
+            else:
+                changed = set()
+                for wd, mask, name in inotify.read(timeout):
+                    if mask & checkerlib.Inotify.IN_Q_OVERFLOW:
+                        changed = set(list_checks()) | set(checks)
+                        break
+                    if wd == runs:
+                        name, ext = os.path.splitext(name)
+                        if ext not in ('.out', '.status'):
+                            continue
+                    changed.add(name)
+                for check_name in changed:
+                    if os.path.isdir(os.path.join(CHECKS_DIR, check_name)):
+                        checks[check_name] = get_check_row(check_name)
+                    else:
+                        checks.pop(check_name, None)
             
-            time.sleep(10)
+            if time.monotonic() >= next_refresh:
+                system = get_system_sections()
+                next_refresh = time.monotonic() + refresh
             
     except KeyboardInterrupt:
+        screen.close()
         print("\nExiting...")
         sys.exit(0)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
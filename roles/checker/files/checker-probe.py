@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import re
+import sys
+import time
+import socket
+import struct
+import asyncio
+
+import checker
+import checkerlib
+
+
+# Echo request payload: target index and sequence number
+PAYLOAD = struct.Struct('!II')
+ICMP_HEADER = struct.Struct('!BBHHH')
+
+# Receive buffer for the replies of all targets arriving at once
+RECEIVE_BUFFER = 4 * 1024 * 1024
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+
+# Nagios exit codes by severity, CRITICAL being the worst
+SEVERITY = [0, 1, 3, 2]
+STATUS_NAMES = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+
+
+def checksum(data):
+    """Internet checksum of an ICMP message."""
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def load_targets(path):
+    """Read targets, one "<name> icmp <host>" or "<name> tcp <host> <port>" per line."""
+    targets = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) < 3 or fields[1] not in ('icmp', 'tcp') or (fields[1] == 'tcp') != (len(fields) == 4):
+                raise ValueError(f"Invalid target: {line.strip()}")
+            name, kind, host = fields[:3]
+            if any(target['name'] == name for target in targets):
+                raise ValueError(f"Duplicate target: {name}")
+            port = int(fields[3]) if kind == 'tcp' else None
+            targets.append({'name': name, 'type': kind, 'host': host, 'port': port})
+    return targets
+
+
+def parse_thresholds(value):
+    """Parse check_ping style "<rta ms>,<loss>%" thresholds."""
+    rta, _, loss = value.partition(',')
+    return float(rta), float(loss.rstrip('%') or 100)
+
+
+class Pinger:
+    """ICMP echo over one socket per address family, for all targets at once.
+
+    Unprivileged ping sockets (net.ipv4.ping_group_range) are preferred, raw
+    sockets are used as fallback when running as root.
+    """
+
+    def __init__(self, family):
+        self.family = family
+        proto = socket.IPPROTO_ICMP if family == socket.AF_INET else socket.IPPROTO_ICMPV6
+        self.request_type, self.reply_type = (8, 0) if family == socket.AF_INET else (128, 129)
+        try:
+            self.sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+            self.raw = False
+        except PermissionError:
+            self.sock = socket.socket(family, socket.SOCK_RAW, proto)
+            self.raw = True
+        self.sock.setblocking(False)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, RECEIVE_BUFFER)
+        except OSError:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        # Ping sockets get their identifier from the kernel
+        self.ident = os.getpid() & 0xffff
+        self.waiting = {}
+        asyncio.get_running_loop().add_reader(self.sock, self.receive)
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.sock)
+        self.sock.close()
+
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            if self.raw and self.family == socket.AF_INET:
+                # Raw IPv4 sockets include the IP header
+                data = data[(data[0] & 0x0f) * 4:]
+            if len(data) < ICMP_HEADER.size + PAYLOAD.size:
+                continue
+            message_type, _, _, ident, _ = ICMP_HEADER.unpack_from(data)
+            if message_type != self.reply_type or (self.raw and ident != self.ident):
+                continue
+            future = self.waiting.pop(PAYLOAD.unpack_from(data, ICMP_HEADER.size), None)
+            if future and not future.done():
+                future.set_result(time.monotonic())
+
+    async def ping(self, address, index, seq, timeout):
+        """Send one echo request, returns the round trip time or None if lost."""
+        payload = PAYLOAD.pack(index, seq)
+        header = ICMP_HEADER.pack(self.request_type, 0, 0, self.ident, seq & 0xffff)
+        if self.family == socket.AF_INET:
+            header = ICMP_HEADER.pack(self.request_type, 0, checksum(header + payload),
+                                      self.ident, seq & 0xffff)
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[(index, seq)] = future
+        sent = time.monotonic()
+        try:
+            self.sock.sendto(header + payload, (address, 0))
+            return await asyncio.wait_for(future, timeout) - sent
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            self.waiting.pop((index, seq), None)
+
+
+async def resolve(host, port=None):
+    """First address of host, preferring the order getaddrinfo returns."""
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return infos[0][0], infos[0][4][0]
+
+
+async def probe_icmp(pingers, index, target, settings):
+    """Ping a target like check_ping, returns exit code and output."""
+    try:
+        family, address = await resolve(target['host'])
+    except OSError as e:
+        return 3, f"PING UNKNOWN - Cannot resolve {target['host']}: {e}"
+    pinger = pingers.get(family)
+    if isinstance(pinger, Exception):
+        return 3, f"PING UNKNOWN - Cannot open ICMP socket: {pinger}"
+
+    count, interval, timeout = settings['count'], settings['interval'], settings['timeout']
+
+    async def echo(seq):
+        await asyncio.sleep(seq * interval)
+        return await pinger.ping(address, index, seq, timeout)
+
+    rtts = [rtt * 1000 for rtt in await asyncio.gather(*(echo(seq) for seq in range(count)))
+            if rtt is not None]
+    loss = 100 * (count - len(rtts)) // count
+    warn_rta, warn_loss = settings['warning']
+    crit_rta, crit_loss = settings['critical']
+    loss_perf = f"pl={loss}%;{warn_loss:g};{crit_loss:g};0"
+    if not rtts:
+        return 2, f"PING CRITICAL - Packet loss = {loss}%|{loss_perf}"
+
+    rta = sum(rtts) / len(rtts)
+    if loss >= crit_loss or rta >= crit_rta:
+        exit_code = 2
+    elif loss >= warn_loss or rta >= warn_rta:
+        exit_code = 1
+    else:
+        exit_code = 0
+    return exit_code, (f"PING {STATUS_NAMES[exit_code]} - Packet loss = {loss}%, RTA = {rta:.2f} ms"
+                       f"|rta={rta:f}ms;{warn_rta:f};{crit_rta:f};0.000000 {loss_perf}")
+
+
+async def probe_tcp(target, settings):
+    """Connect to a target like check_tcp, returns exit code and output."""
+    timeout = settings['timeout']
+    start = time.monotonic()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(target['host'], target['port']), timeout)
+    except asyncio.TimeoutError:
+        return 2, f"TCP CRITICAL - Socket timeout after {timeout:g} seconds"
+    except OSError as e:
+        return 2, f"TCP CRITICAL - {os.strerror(e.errno) if e.errno else e}"
+    elapsed = time.monotonic() - start
+    writer.close()
+
+    if elapsed >= settings['tcp_critical']:
+        exit_code = 2
+    elif elapsed >= settings['tcp_warning']:
+        exit_code = 1
+    else:
+        exit_code = 0
+    return exit_code, (f"TCP {STATUS_NAMES[exit_code]} - {elapsed:.3f} second response time "
+                       f"on {target['host']} port {target['port']}"
+                       f"|time={elapsed:f}s;{settings['tcp_warning']:f};{settings['tcp_critical']:f}"
+                       f";0.000000;{timeout:f}")
+
+
+def write_result(run_file, exit_code, output, start, end):
+    """Write the run file and status header of one target."""
+    data = (output + '\n').encode()
+    tmp_file = f"{run_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, run_file)
+    checkerlib.write_status(run_file, {
+        'Exit-Code': exit_code,
+        'Start': f"{start:.3f}",
+        'End': f"{end:.3f}",
+        'Duration': f"{end - start:.3f}",
+        'Output-Bytes': len(data),
+        'Output-Truncated': 0,
+        'Perfdata-Offset': data.find(b'|'),
+    })
+
+
+async def probe_all(targets, settings):
+    """Probe all targets concurrently, returns (exit code, output, start, end) per target."""
+    limit = asyncio.Semaphore(settings['concurrency'])
+    pingers = {}
+    if any(target['type'] == 'icmp' for target in targets):
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                pingers[family] = Pinger(family)
+            except OSError as e:
+                pingers[family] = e
+
+    async def probe(index, target):
+        async with limit:
+            start = time.time()
+            if target['type'] == 'icmp':
+                exit_code, output = await probe_icmp(pingers, index, target, settings)
+            else:
+                exit_code, output = await probe_tcp(target, settings)
+            return exit_code, output, start, time.time()
+
+    try:
+        return await asyncio.gather(*(probe(index, target) for index, target in enumerate(targets)))
+    finally:
+        for pinger in pingers.values():
+            if isinstance(pinger, Pinger):
+                pinger.close()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: checker-probe.py <targets_file>", file=sys.stderr)
+        sys.exit(3)
+
+    env = os.environ
+    check_id = env.get('PROBE_CHECK_ID') or os.path.basename(os.getcwd())
+    try:
+        targets = load_targets(sys.argv[1])
+        settings = {
+            'count': int(env.get('PROBE_COUNT', '5')),
+            'interval': float(env.get('PROBE_INTERVAL', '0.2')),
+            'timeout': float(env.get('PROBE_TIMEOUT', '10')),
+            'concurrency': int(env.get('PROBE_CONCURRENCY', '256')),
+            'warning': parse_thresholds(env.get('PROBE_ICMP_WARNING', '100,20%')),
+            'critical': parse_thresholds(env.get('PROBE_ICMP_CRITICAL', '500,60%')),
+            'tcp_warning': float(env.get('PROBE_TCP_WARNING', '1')),
+            'tcp_critical': float(env.get('PROBE_TCP_CRITICAL', '5')),
+        }
+        if settings['count'] < 1 or settings['concurrency'] < 1:
+            raise ValueError("PROBE_COUNT and PROBE_CONCURRENCY must be at least 1")
+    except (OSError, ValueError) as e:
+        print(f"PROBE UNKNOWN - {e}")
+        sys.exit(3)
+
+    results = asyncio.run(probe_all(targets, settings))
+
+    # Fan out into one run file per target, notify.py notifies each like a
+    # check of its own once the probe finished, outside of its CHECK_TIMEOUT
+    notify = env.get('PROBE_NOTIFY', 'true') == 'true' and os.path.basename(checker.NOTIFY_CMD) == 'notify.py'
+    pending = []
+    counts = {code: 0 for code in STATUS_NAMES}
+    problems = []
+    for target, (exit_code, output, start, end) in zip(targets, results):
+        target_id = f"{check_id}-{re.sub(r'[^A-Za-z0-9_.-]', '_', target['name'])}"
+        run_file = os.path.join(checker.RUN_DIR, f"{target_id}.out")
+        write_result(run_file, exit_code, output, start, end)
+        checker.record_history(target_id, run_file, exit_code, end)
+        pending.append((target_id, exit_code, run_file))
+        counts[exit_code] += 1
+        if exit_code != 0:
+            problems.append((SEVERITY.index(exit_code), f"{target['name']}: {output.split('|')[0]}"))
+
+    if notify:
+        checkerlib.write_targets(os.path.join(checker.RUN_DIR, f"{check_id}.out"), pending)
+
+    exit_code = max((SEVERITY.index(code) for code, count in counts.items() if count), default=0)
+    exit_code = SEVERITY[exit_code]
+    summary = ', '.join(f"{counts[code]} {STATUS_NAMES[code]}" for code in (0, 1, 2, 3) if counts[code])
+    print(f"PROBE {STATUS_NAMES[exit_code]} - {len(targets)} targets: {summary or 'none'}"
+          f"|ok={counts[0]};;;0;{len(targets)} problems={len(targets) - counts[0]};;;0;{len(targets)}")
+    for _, line in sorted(problems, reverse=True):
+        print(line)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
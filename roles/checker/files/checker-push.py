@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import signal
+import socket
+import http.client
+import urllib.parse
+
+import checkerlib
+
+
+RUN_DIR = os.environ.get('CHECKER_RUN_DIR', '/run/checker')
+PUSH_URL = os.environ.get('CHECKER_PUSH_URL', '')
+PUSH_KEY = os.environ.get('CHECKER_PUSH_KEY', '')
+PUSH_INTERVAL = float(os.environ.get('CHECKER_PUSH_INTERVAL', '10'))
+PUSH_HEARTBEAT = float(os.environ.get('CHECKER_PUSH_HEARTBEAT', '60'))
+PUSH_TIMEOUT = float(os.environ.get('CHECKER_PUSH_TIMEOUT', '10'))
+PUSH_ENVIRONMENT = os.environ.get('CHECKER_PUSH_ENVIRONMENT', 'production')
+PUSH_BACKOFF_MAX = 300
+
+# Bytes of a run file read for its text and performance data
+OUTPUT_READ_MAX = 65536
+
+# Alerta severities of the Nagios exit codes, as used by notify-alerta.py
+SEVERITIES = {0: 'ok', 1: 'warning', 2: 'critical', 3: 'unknown'}
+
+
+def read_result(run_file):
+    """Current result of a check as sent to the collector, None if it has none.
+
+    Exit code, timestamp and duration come from the status header, text and
+    performance data from the first line of the run file.
+    """
+    status = checkerlib.read_status(run_file)
+    try:
+        with open(run_file, 'r', errors='replace') as f:
+            output = f.read(OUTPUT_READ_MAX)
+            mtime = os.fstat(f.fileno()).st_mtime
+    except OSError:
+        if status is None:
+            return None
+        output, mtime = '', None
+
+    def number(key, default=None):
+        try:
+            return float(status[key])
+        except (KeyError, TypeError, ValueError):
+            return default
+
+    exit_code = int(number('Exit-Code', 3)) if status else None
+    return {
+        'severity': SEVERITIES.get(exit_code, 'unknown'),
+        'value': exit_code,
+        'timestamp': number('End', mtime) if status else mtime,
+        'duration': number('Duration') if status else None,
+        'text': output.split('\n', 1)[0].split('|', 1)[0].strip(),
+        'perfdata': {metric.label: [metric.value, metric.uom]
+                     for metric in checkerlib.parse_perfdata(output)},
+    }
+
+
+def scan(run_dir):
+    """Results of all checks in the run directory."""
+    results = {}
+    for path in glob.glob(os.path.join(run_dir, '*.out')) + glob.glob(os.path.join(run_dir, '*.status')):
+        check_id = os.path.splitext(os.path.basename(path))[0]
+        if check_id not in results:
+            result = read_result(os.path.join(run_dir, f"{check_id}.out"))
+            if result is not None:
+                results[check_id] = result
+    return results
+
+
+class CollectorConnection:
+    """Keep-alive HTTP(S) connection to the collector."""
+
+    def __init__(self, url, key, timeout):
+        url = urllib.parse.urlsplit(url)
+        self.path = url.path + (f"?{url.query}" if url.query else "")
+        self.headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        if key:
+            self.headers['Authorization'] = f"Key {key}"
+        if url.scheme == 'https':
+            self.connection = http.client.HTTPSConnection(url.hostname, url.port, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+
+    def post(self, push):
+        """Post one push, reconnecting once if the collector closed the connection."""
+        body = gzip.compress(json.dumps(push, separators=(',', ':')).encode(), 6)
+        for attempt in (1, 2):
+            try:
+                self.connection.request('POST', self.path, body=body, headers=self.headers)
+                response = self.connection.getresponse()
+                return response.status, response.read().decode(errors='replace')
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.connection.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        self.connection.close()
+
+
+class Pusher:
+    """Ship the local result table to the collector as deltas.
+
+    Each push carries the results that changed since the last push the
+    collector acknowledged, numbered within a session. A collector that
+    missed a push or restarted answers 409 and gets the full table.
+    """
+
+    def __init__(self, connection, resource, environment):
+        self.connection = connection
+        self.resource = resource
+        self.environment = environment
+        self.session = os.urandom(8).hex()
+        self.seq = 0
+        self.acked = None
+        self.last_push = 0
+
+    def build(self, results, full):
+        if full:
+            changed, removed = results, []
+        else:
+            changed = {check_id: result for check_id, result in results.items()
+                       if self.acked.get(check_id) != result}
+            removed = [check_id for check_id in self.acked if check_id not in results]
+        return {
+            'resource': self.resource,
+            'environment': self.environment,
+            'session': self.session,
+            'seq': self.seq + 1,
+            'full': full,
+            'time': time.time(),
+            'results': [dict(result, event=check_id) for check_id, result in changed.items()],
+            'removed': removed,
+        }
+
+    def push(self, results, heartbeat):
+        """Send the changes, or an empty push as heartbeat if none are due."""
+        full = self.acked is None
+        push = self.build(results, full)
+        if not full and not push['results'] and not push['removed'] \
+                and time.monotonic() - self.last_push < heartbeat:
+            return
+
+        status, body = self.connection.post(push)
+        if status == 409 and not full:
+            # The collector lost track of this host, start over with the full table
+            self.acked = None
+            push = self.build(results, True)
+            status, body = self.connection.post(push)
+        if status != 200:
+            raise RuntimeError(f"HTTP {status}: {body.strip()}")
+        self.seq = push['seq']
+        self.acked = dict(results)
+        self.last_push = time.monotonic()
+
+
+def main():
+    if not PUSH_URL:
+        print("Error: CHECKER_PUSH_URL is not set", file=sys.stderr)
+        sys.exit(1)
+
+    stop = []
+    signal.signal(signal.SIGTERM, lambda *_: stop.append(True))
+    signal.signal(signal.SIGINT, lambda *_: stop.append(True))
+
+    inotify = checkerlib.Inotify()
+    inotify.add_watch(RUN_DIR, checkerlib.Inotify.IN_CLOSE_WRITE
+                      | checkerlib.Inotify.IN_MOVED_TO | checkerlib.Inotify.IN_MOVED_FROM
+                      | checkerlib.Inotify.IN_DELETE | checkerlib.Inotify.IN_ONLYDIR)
+    # Files changed before the watch was added are picked up by the scan
+    results = scan(RUN_DIR)
+    connection = CollectorConnection(PUSH_URL, PUSH_KEY, PUSH_TIMEOUT)
+    pusher = Pusher(connection, socket.gethostname(), PUSH_ENVIRONMENT)
+    print(f"Pushing {len(results)} check results to {PUSH_URL} every {PUSH_INTERVAL:g}s")
+
+    changed = set()
+    backoff = 0
+    next_push = time.monotonic()
+    try:
+        while not stop:
+            for _, mask, name in inotify.read(timeout=min(max(next_push - time.monotonic(), 0), 1)):
+                if mask & checkerlib.Inotify.IN_Q_OVERFLOW:
+                    results = scan(RUN_DIR)
+                    changed.clear()
+                    break
+                base, ext = os.path.splitext(name)
+                if ext in ('.out', '.status'):
+                    changed.add(base)
+            if time.monotonic() < next_push:
+                continue
+
+            # Re-read only the checks that ran since the last push
+            for check_id in changed:
+                result = read_result(os.path.join(RUN_DIR, f"{check_id}.out"))
+                if result is None:
+                    results.pop(check_id, None)
+                else:
+                    results[check_id] = result
+            changed.clear()
+
+            try:
+                pusher.push(results, PUSH_HEARTBEAT)
+                if backoff:
+                    print("Collector reachable again")
+                backoff = 0
+            except (OSError, http.client.HTTPException, RuntimeError) as e:
+                connection.close()
+                backoff = min(max(backoff * 2, PUSH_INTERVAL), PUSH_BACKOFF_MAX)
+                print(f"Failed to push to {PUSH_URL}, retrying in {backoff:g}s: {e}", file=sys.stderr)
+            next_push = time.monotonic() + (backoff or PUSH_INTERVAL)
+    finally:
+        inotify.close()
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,39 +2,989 @@
 # SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
 # SPDX-License-Identifier: Apache-2.0
 
+import os
 import sys
+import glob
+import fcntl
+import heapq
+import hashlib
+import queue
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import resource
+import threading
 import subprocess
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep, time
+
+import checkerlib
+
+
+CONFIG_DIR = os.environ.get('CHECKER_CONFIG_DIR', '/etc/checker')
+CHECKS_DIR = os.environ.get('CHECKER_CHECKS_DIR', '/etc/checker/checks')
+NOTIFIERS_DIR = os.environ.get('CHECKER_NOTIFIERS_DIR', '/etc/checker/notifiers')
+RUN_DIR = os.environ.get('CHECKER_RUN_DIR', '/run/checker')
+NOTIFY_CMD = os.environ.get('CHECKER_NOTIFY', '/etc/checker/notify.sh')
+METRICS_DIR = os.environ.get('CHECKER_METRICS_DIR', '/var/lib/checker/metrics')
+CACHE_DIR = os.environ.get('CHECKER_CACHE_DIR', os.path.join(RUN_DIR, 'cache'))
+CHECK_PATH = '/usr/lib/nagios/plugins:/usr/local/bin:/usr/bin:/bin'
+
+# Output is read from the check in chunks of this size
+CHUNK_SIZE = 65536
+
+# Admission control: PSI thresholds in percent of stalled time over the last
+# 10 seconds, and checks running at once across all checker processes
+PRESSURE_DIR = '/proc/pressure'
+PRESSURE_DEFAULTS = {'cpu': 80, 'memory': 20, 'io': 50}
+SLOTS_DIR = os.path.join(RUN_DIR, 'slots')
+
+# Process limits are applied by prlimit(1) between fork and exec of check.sh,
+# a preexec_fn could deadlock in the child of the threaded scheduler
+PRLIMIT = shutil.which('prlimit')
+PRLIMIT_OPTIONS = {resource.RLIMIT_AS: 'as', resource.RLIMIT_NOFILE: 'nofile', resource.RLIMIT_NPROC: 'nproc'}
+
+# Memory and CPU limits need a cgroup, checks of the scheduler get one from
+# systemd-run(1) like checker@.service does, if systemd is running
+SYSTEMD_RUN = shutil.which('systemd-run') if os.path.isdir('/run/systemd/system') else None
+
+# check.env settings validated by compile, by type of value
+TIMESPAN_SETTINGS = ('CHECK_INTERVAL', 'CHECK_INTERVAL_MIN', 'CHECK_INTERVAL_MAX', 'CHECK_TIMEOUT',
+                     'CHECK_CACHE_TTL', 'CHECK_METRICS_DOWNSAMPLE')
+INTEGER_SETTINGS = ('CHECK_METRICS_RETENTION', 'CHECK_METRICS_DOWNSAMPLE_RETENTION',
+                    'CHECK_LIMIT_NOFILE', 'CHECK_LIMIT_NPROC')
+PRIORITIES = ('critical', 'normal', 'low')
+
+
+def load_env(env_file):
+    """Load a systemd style environment file into a dict."""
+    env = {}
+    try:
+        with open(env_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    key, value = line.split('=', 1)
+                    # Remove quotes if present
+                    env[key.strip()] = value.strip().strip('"').strip("'")
+    except IOError:
+        pass
+    return env
+
+
+def parse_size(value):
+    """Convert a systemd size like 100M into bytes, None if unlimited."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = (value or '').strip().upper()
+    if not value or value == 'INFINITY':
+        return None
+    try:
+        if value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        return None
+
+
+def load_checks():
+    """Load all checks from the registry, or find all check directories and load their check.env."""
+    registry = checkerlib.read_registry()
+    if registry and registry.fresh(CHECKS_DIR):
+        entries = registry.checks()
+        for entry in entries.values():
+            # Edited in place since compiling
+            env_file = os.path.join(entry['dir'], 'check.env')
+            if checkerlib.file_stamp(env_file) != entry.get('stamp'):
+                entry['env'] = load_env(env_file)
+    else:
+        entries = {}
+        for check_dir in glob.glob(os.path.join(CHECKS_DIR, '*/')):
+            if os.access(os.path.join(check_dir, 'check.sh'), os.X_OK):
+                entries[os.path.basename(check_dir.rstrip('/'))] = {
+                    'dir': check_dir,
+                    'env': load_env(os.path.join(check_dir, 'check.env')),
+                }
+
+    checks = {}
+    for check_id, entry in entries.items():
+        check_dir, env = entry['dir'], entry['env']
+        interval = checkerlib.parse_timespan(env.get('CHECK_INTERVAL'), 60)
+        checks[check_id] = {
+            'dir': check_dir,
+            'env': env,
+            'interval': interval,
+            'interval_min': min(checkerlib.parse_timespan(env.get('CHECK_INTERVAL_MIN'), interval), interval),
+            'interval_max': max(checkerlib.parse_timespan(env.get('CHECK_INTERVAL_MAX'), interval), interval),
+            'backoff': max(checkerlib.parse_number(env.get('CHECK_INTERVAL_BACKOFF'), 2), 1),
+            'depends': parse_depends(env),
+        }
+    for check_id in break_cycles(checks):
+        print(f"Error: {check_id} depends on itself, ignoring its CHECK_DEPENDS", file=sys.stderr)
+    return checks
+
+
+def parse_depends(env):
+    """Parent checks of a check from CHECK_DEPENDS, separated by commas or spaces."""
+    return env.get('CHECK_DEPENDS', '').replace(',', ' ').split()
+
+
+def break_cycles(checks):
+    """Drop the parents of checks that depend on themselves, returns their ids."""
+    cyclic = []
+    for check_id in sorted(checks):
+        ancestors = set()
+        pending = list(checks[check_id]['depends'])
+        while pending:
+            parent = pending.pop()
+            if parent in checks and parent not in ancestors:
+                ancestors.add(parent)
+                pending.extend(checks[parent]['depends'])
+        if check_id in ancestors:
+            checks[check_id]['depends'] = []
+            cyclic.append(check_id)
+    return cyclic
+
+
+def parse_env_file(path):
+    """Parse an environment file like load_env, returns (env, errors)."""
+    env = {}
+    errors = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, sep, value = line.partition('=')
+            if not sep or not key.strip().isidentifier():
+                errors.append(f"{os.path.basename(path)}:{number}: expected KEY=value")
+                continue
+            env[key.strip()] = value.strip().strip('"').strip("'")
+    return env, errors
+
+
+def validate_check_env(env):
+    """Errors in the settings of a check.env."""
+    errors = []
+    for key in TIMESPAN_SETTINGS:
+        if env.get(key):
+            try:
+                checkerlib.timespan_seconds(env[key])
+            except ValueError as e:
+                errors.append(f"{key}: {e}")
+    for key in INTEGER_SETTINGS:
+        if env.get(key) and not env[key].isdigit():
+            errors.append(f"{key}={env[key]} is no integer")
+    try:
+        float(env.get('CHECK_INTERVAL_BACKOFF') or 2)
+    except ValueError:
+        errors.append(f"CHECK_INTERVAL_BACKOFF={env['CHECK_INTERVAL_BACKOFF']} is no number")
+    output_max = env.get('CHECK_OUTPUT_MAX', '')
+    if output_max and output_max.lower() != 'infinity' and parse_size(output_max) is None:
+        errors.append(f"CHECK_OUTPUT_MAX={output_max} is no size")
+    if env.get('CHECK_PRIORITY', 'normal') not in PRIORITIES:
+        errors.append(f"CHECK_PRIORITY={env['CHECK_PRIORITY']} is none of {', '.join(PRIORITIES)}")
+    return errors
+
+
+def compile_registry():
+    """Validate all checks and notifiers and write the registry, returns the exit code.
+
+    Notifier configurations that are not world readable are validated but
+    left out, as the registry is.
+    """
+    errors = []
+    warnings = []
+    # Taken before scanning, so changes made meanwhile leave the registry stale
+    mtimes = {path: os.stat(path).st_mtime_ns for path in (CHECKS_DIR, NOTIFIERS_DIR)
+              if os.path.isdir(path)}
+
+    entries = {}
+    for check_dir in sorted(glob.glob(os.path.join(CHECKS_DIR, '*/'))):
+        check_id = os.path.basename(check_dir.rstrip('/'))
+        if not os.access(os.path.join(check_dir, 'check.sh'), os.X_OK):
+            errors.append(f"{check_id}: check.sh is missing or not executable")
+            continue
+        env_file = os.path.join(check_dir, 'check.env')
+        # Taken before parsing, like the directory mtimes
+        stamp = checkerlib.file_stamp(env_file)
+        env, env_errors = {}, []
+        if stamp is not None:
+            env, env_errors = parse_env_file(env_file)
+        errors += [f"{check_id}: {error}" for error in env_errors + validate_check_env(env)]
+        entries[check_id] = {'dir': check_dir, 'env': env, 'stamp': stamp}
+
+    checks = {check_id: {'depends': parse_depends(entry['env'])} for check_id, entry in entries.items()}
+    for check_id, check in sorted(checks.items()):
+        for parent in check['depends']:
+            # Per-target results of checker-probe.py are named <check_id>-<name>
+            if parent not in checks and not any(parent.startswith(f"{other}-") for other in checks):
+                warnings.append(f"{check_id}: CHECK_DEPENDS parent {parent} is no check")
+    errors += [f"{check_id}: depends on itself through CHECK_DEPENDS" for check_id in break_cycles(checks)]
+
+    plugins = []
+    for path in sorted(glob.glob(os.path.join(NOTIFIERS_DIR, '*.py'))):
+        try:
+            with open(path, 'rb') as f:
+                compile(f.read(), path, 'exec')
+        except (OSError, SyntaxError, ValueError) as e:
+            errors.append(f"{os.path.basename(path)}: {e}")
+            continue
+        plugins.append(path)
+    scripts = []
+    for path in sorted(glob.glob(os.path.join(NOTIFIERS_DIR, '*.sh'))):
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            scripts.append(path)
+        else:
+            warnings.append(f"{os.path.basename(path)}: not executable, not notifying with it")
+
+    configs = {}
+    for path in sorted(glob.glob(os.path.join(CONFIG_DIR, 'notify_*.env'))):
+        stat = os.stat(path)
+        env, env_errors = parse_env_file(path)
+        errors += env_errors
+        if stat.st_mode & 0o004:
+            mtimes[path] = stat.st_mtime_ns
+            configs[path] = env
+
+    for warning in warnings:
+        print(f"Warning: {warning}", file=sys.stderr)
+    for error in errors:
+        print(f"Error: {error}", file=sys.stderr)
+    if errors:
+        print(f"Not writing {checkerlib.REGISTRY_FILE}, found {len(errors)} errors", file=sys.stderr)
+        return 1
+
+    checkerlib.write_registry({
+        'compiled': time(),
+        'mtimes': mtimes,
+        'plugins': plugins,
+        'scripts': scripts,
+        'configs': configs,
+    }, entries)
+    print(f"Compiled {len(entries)} checks and {len(plugins) + len(scripts)} notifiers "
+          f"into {checkerlib.REGISTRY_FILE}")
+    return 0
+
+
+def next_interval(check, exit_code, previous):
+    """Interval until the next run of a check, adapted to its state.
+
+    While a check is not OK it is retried every CHECK_INTERVAL_MIN. Once it
+    is OK it runs every CHECK_INTERVAL, and the interval grows by
+    CHECK_INTERVAL_BACKOFF with every further OK run up to
+    CHECK_INTERVAL_MAX. previous is the (exit code, interval) of the last
+    run, or None.
+    """
+    if exit_code != 0:
+        return check['interval_min']
+    if previous is None or previous[0] != 0:
+        return check['interval']
+    interval = max(previous[1], check['interval']) * check['backoff']
+    return min(interval, check['interval_max'])
+
+
+def open_schedule():
+    """Open the persisted scheduler state, creating it if needed."""
+    db = checkerlib.open_state_db()
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS schedule ("
+        " check_id TEXT PRIMARY KEY,"
+        " exit_code INTEGER NOT NULL,"
+        " interval REAL NOT NULL,"
+        " next_run REAL NOT NULL)"
+    )
+    return db
+
+
+def read_pressure(resource_name):
+    """Share of time some tasks stalled on a resource over the last 10 seconds.
+
+    Returns the avg10 value in percent from /proc/pressure, None if the
+    kernel does not provide pressure stall information.
+    """
+    try:
+        with open(os.path.join(PRESSURE_DIR, resource_name), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(dict(field.split('=', 1) for field in fields[1:])['avg10'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def acquire_slot(limit, wait):
+    """Take one of limit slots shared by all checker processes.
+
+    Slots are lock files in SLOTS_DIR held with flock() for as long as the
+    returned file stays open, so slots of crashed runs are freed by the
+    kernel. Waits up to wait seconds, returns None if no slot got free.
+    """
+    os.makedirs(SLOTS_DIR, exist_ok=True)
+    deadline = monotonic() + wait
+    while True:
+        for index in range(limit):
+            slot = open(os.path.join(SLOTS_DIR, f"{index}.lock"), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                slot.close()
+        if monotonic() >= deadline:
+            return None
+        sleep(random.uniform(0.1, 0.3))
+
+
+def admit(check_env):
+    """Decide whether a check may start on this host now.
+
+    CHECK_PRIORITY critical checks always run, normal checks are deferred
+    while a CHECKER_PRESSURE_* threshold is exceeded or no slot of
+    CHECKER_MAX_RUNNING got free within CHECKER_ADMISSION_WAIT, low checks
+    already at half the thresholds and without waiting for a slot.
+    Returns (slot, reason), reason is None if the check may run and the
+    slot, if any, has to be kept open while it runs.
+    """
+    priority = check_env.get('CHECK_PRIORITY', os.environ.get('CHECK_PRIORITY', 'normal'))
+    limit = checkerlib.parse_number(os.environ.get('CHECKER_MAX_RUNNING'), 0, int)
+
+    if priority == 'critical':
+        return (acquire_slot(limit, 0) if limit > 0 else None), None
+
+    factor = 0.5 if priority == 'low' else 1
+    for resource_name, default in PRESSURE_DEFAULTS.items():
+        threshold = checkerlib.parse_number(
+            os.environ.get(f"CHECKER_PRESSURE_{resource_name.upper()}"), default) * factor
+        pressure = read_pressure(resource_name)
+        if threshold > 0 and pressure is not None and pressure > threshold:
+            return None, f"{resource_name} pressure {pressure:.1f}% above {threshold:g}%"
+
+    if limit <= 0:
+        return None, None
+    wait = 0 if priority == 'low' else checkerlib.parse_timespan(os.environ.get('CHECKER_ADMISSION_WAIT'), 10)
+    slot = acquire_slot(limit, wait)
+    if slot is None:
+        return None, f"all {limit} slots busy"
+    return slot, None
+
+
+def record_deferred(run_file, reason):
+    """Mark the last result of a check as deferred, keeping its run file."""
+    status = checkerlib.read_status(run_file) or {}
+    status.pop('Checker-Status', None)
+    status['Deferred'] = f"{time():.3f}"
+    status['Deferred-Reason'] = reason
+    checkerlib.write_status(run_file, status)
+
+
+def unreachable(check_id, check_env):
+    """Find a CRITICAL parent hiding a check, returns (root, reason) or (None, None).
+
+    A check is unreachable while one of its CHECK_DEPENDS parents is CRITICAL
+    or unreachable itself, root is the CRITICAL check the outage starts at.
+    Parents are looked up by their run file, so per-target results of
+    checker-probe.py work as parents too.
+    """
+    for parent in parse_depends(check_env):
+        if parent == check_id:
+            continue
+        status = checkerlib.read_status(os.path.join(RUN_DIR, f"{parent}.out"))
+        if not status:
+            continue
+        try:
+            if float(status.get('Unreachable', 0)) > float(status.get('End', 0)):
+                # A root back at this check means a cycle, which is no outage
+                root = status.get('Unreachable-Root')
+                if root and root != check_id:
+                    return root, f"{parent} is unreachable, {root} is CRITICAL"
+            elif int(status.get('Exit-Code', 0)) == 2:
+                return parent, f"{parent} is CRITICAL"
+        except ValueError:
+            continue
+    return None, None
+
+
+def record_unreachable(run_file, root):
+    """Mark the last result of a check as unreachable, keeping its run file."""
+    status = checkerlib.read_status(run_file) or {}
+    status.pop('Checker-Status', None)
+    status['Unreachable'] = f"{time():.3f}"
+    status['Unreachable-Root'] = root
+    checkerlib.write_status(run_file, status)
+
+
+def limit_resources(env):
+    """Limits from check.env as (limit, value) pairs.
+
+    A limit is a resource.RLIMIT_* constant or a property of the scope the
+    check runs in. Without systemd, CHECK_MEMORY_MAX limits the address
+    space instead of the memory and CHECK_CPU_QUOTA is not applied.
+    """
+    limits = []
+    memory_max = parse_size(env.get('CHECK_MEMORY_MAX'))
+    cpu_quota = env.get('CHECK_CPU_QUOTA', '').strip()
+    if SYSTEMD_RUN:
+        if memory_max:
+            limits.append(('MemoryMax', memory_max))
+        if cpu_quota:
+            limits.append(('CPUQuota', cpu_quota))
+    elif memory_max:
+        limits.append((resource.RLIMIT_AS, memory_max))
+    for key, limit in (('CHECK_LIMIT_NOFILE', resource.RLIMIT_NOFILE),
+                       ('CHECK_LIMIT_NPROC', resource.RLIMIT_NPROC)):
+        value = parse_size(env.get(key))
+        if value:
+            limits.append((limit, value))
+    return limits
+
+
+def check_command(limits):
+    """Command running check.sh, through prlimit(1) and systemd-run(1) if there are limits."""
+    command = ['./check.sh']
+    rlimits = [(limit, value) for limit, value in limits if not isinstance(limit, str)]
+    if rlimits and PRLIMIT:
+        command = [PRLIMIT] + [f"--{PRLIMIT_OPTIONS[limit]}={value}:{value}" for limit, value in rlimits] \
+            + ['--'] + command
+    properties = [f"--property={name}={value}" for name, value in limits if isinstance(name, str)]
+    if properties:
+        # A scope runs the command in place, it stays a child of the scheduler
+        command = [SYSTEMD_RUN, '--scope', '--quiet', '--collect'] + properties + ['--'] + command
+    return command
+
+
+def apply_limits(pid, limits):
+    """Apply process limits to a started check, if prlimit(1) is not installed."""
+    for limit, value in limits:
+        if isinstance(limit, str):
+            continue
+        try:
+            resource.prlimit(pid, limit, (value, value))
+        except (ProcessLookupError, PermissionError):
+            return
+
+
+class OutputCapture:
+    """Bounded capture of check output into a run file.
+
+    Output is written to a temporary file next to the run file, which
+    replaces the run file once the check finished, so readers never see a
+    partial run. With a maximum size only the first half of it is written
+    through, of the rest only the last half is kept in memory and written
+    after a truncation marker.
+    """
+
+    def __init__(self, run_file, max_bytes=None, tee=None):
+        self.run_file = run_file
+        self.tmp_file = f"{run_file}.{os.getpid()}.tmp"
+        self.file = open(self.tmp_file, 'wb', buffering=CHUNK_SIZE)
+        self.tee = tee
+        self.head = max_bytes // 2 if max_bytes else None
+        self.tail_max = max_bytes - self.head if max_bytes else None
+        self.written = 0
+        self.tail = bytearray()
+        self.truncated = 0
+
+    def write(self, data):
+        if self.tee:
+            self.tee.write(data)
+            self.tee.flush()
+        if self.head is None:
+            self.file.write(data)
+            return
+        room = self.head - self.written
+        if room > 0:
+            self.file.write(data[:room])
+            self.written += min(room, len(data))
+            data = data[room:]
+        if data:
+            self.tail += data
+            excess = len(self.tail) - self.tail_max
+            if excess > 0:
+                del self.tail[:excess]
+                self.truncated += excess
+
+    def read_from(self, fd):
+        """Capture everything from fd until all writers closed it."""
+        while True:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                return
+            self.write(data)
+
+    def finish(self):
+        """Move the captured output into place, returns the truncated bytes."""
+        if self.truncated:
+            # Resume at a line start after the marker
+            newline = self.tail.find(b'\n')
+            if 0 <= newline < len(self.tail) - 1:
+                del self.tail[:newline + 1]
+                self.truncated += newline + 1
+            self.file.write(f"\n[{self.truncated} bytes of output truncated]\n".encode())
+        self.file.write(self.tail)
+        self.file.close()
+        os.replace(self.tmp_file, self.run_file)
+        return self.truncated
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_file)
+        except FileNotFoundError:
+            pass
+
+
+def wait_check(process, timeout=None, capture=None):
+    """Wait for check.sh, killing its process group once the timeout passed.
+
+    The output of the check is read into capture first if given. Returns
+    the exit code, the resource usage of the check and whether it timed out.
+    """
+    timed_out = threading.Event()
+
+    def kill():
+        # Kill the whole process group, like systemd does with the cgroup
+        timed_out.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.start()
+    try:
+        if capture:
+            capture.read_from(process.stdout.fileno())
+        _, wait_status, rusage = os.wait4(process.pid, 0)
+    finally:
+        if timer:
+            timer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    return process.returncode, rusage, timed_out.is_set()
+
+
+def write_result_status(run_file, exit_code, start, end, truncated=0):
+    """Write the status header with exit code, timing and output metadata."""
+    with open(run_file, 'rb') as f:
+        output_bytes = os.fstat(f.fileno()).st_size
+        # Nagios plugins put their performance data after a | in the first line
+        first_line = f.readline(65536)
+    perfdata_offset = first_line.find(b'|')
+
+    checkerlib.write_status(run_file, {
+        'Exit-Code': exit_code,
+        'Start': f"{start:.3f}",
+        'End': f"{end:.3f}",
+        'Duration': f"{end - start:.3f}",
+        'Output-Bytes': output_bytes,
+        'Output-Truncated': truncated,
+        'Perfdata-Offset': perfdata_offset,
+    })
+
+
+def stage(started, rusage=None, output_bytes=None, **values):
+    """Timing record of a stage started at the monotonic time started."""
+    record = {'wall_seconds': round(monotonic() - started, 6)}
+    if rusage:
+        record['cpu_seconds'] = round(rusage.ru_utime + rusage.ru_stime, 6)
+    if output_bytes is not None:
+        record['output_bytes'] = output_bytes
+    record.update(values)
+    return record
+
+
+def execute_check(run_file, check_env, timeout=None, tee=None, stages=None, limits=(), **popen_args):
+    """Run check.sh into run_file and write its status header.
+
+    Returns the exit code and the end time of the run. The check and write
+    stage timings are added to stages if given, limits from
+    limit_resources() are applied to the check.
+    """
+    start = time()
+    started = monotonic()
+    capture = OutputCapture(run_file, parse_size(check_env.get('CHECK_OUTPUT_MAX', '1M')), tee)
+    try:
+        process = subprocess.Popen(
+            check_command(limits),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            **popen_args
+        )
+        if limits and not PRLIMIT:
+            # Racy, the check may already be running, but still better than no limits
+            apply_limits(process.pid, limits)
+        with process.stdout:
+            exit_code, rusage, timed_out = wait_check(process, timeout, capture)
+        exited = monotonic()
+        if timed_out:
+            capture.write(f"\nCheck timed out after {timeout:g}s\n".encode())
+            exit_code = 3
+        truncated = capture.finish()
+    except BaseException:
+        capture.abort()
+        raise
+    end = time()
+    write_result_status(run_file, exit_code, start, end, truncated)
+    if stages is not None:
+        # wait4() accounts the check with all descendants it waited for
+        stages['check'] = dict(stage(started, rusage), wall_seconds=round(exited - started, 6),
+                               exit_code=exit_code)
+        stages['write'] = stage(exited, output_bytes=os.stat(run_file).st_size)
+    return exit_code, end
+
+
+def cache_key(check_dir, check_env):
+    """Hash of check.sh, the check variables it runs with and its sharing scope.
+
+    check.sh may read files from its own directory, so only checks setting
+    the same CHECK_CACHE_KEY share results, others are keyed by their check
+    directory. Checker settings (CHECK_* and NOTIFY_*) are left out, so
+    checks running the same command with different schedules or limits can
+    share results.
+    """
+    digest = hashlib.sha256()
+    scope = check_env.get('CHECK_CACHE_KEY') or f"dir:{os.path.realpath(check_dir)}"
+    digest.update(f"{scope}\0".encode())
+    with open(os.path.join(check_dir, 'check.sh'), 'rb') as f:
+        digest.update(f.read())
+    for key, value in sorted(check_env.items()):
+        if not key.startswith(('CHECK_', 'NOTIFY_')):
+            digest.update(f"\0{key}={value}".encode())
+    return digest.hexdigest()
+
+
+def link_into_place(source, destination):
+    """Hard link source to destination, replacing it atomically."""
+    try:
+        if os.path.samefile(source, destination):
+            # Already linked by an earlier hit, replacing would leave the link behind
+            return
+    except FileNotFoundError:
+        if not os.path.exists(source):
+            raise
+    tmp_file = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.link(source, tmp_file)
+    try:
+        os.replace(tmp_file, destination)
+    finally:
+        # rename() of a link onto the same inode succeeds without removing it
+        if os.path.lexists(tmp_file):
+            os.unlink(tmp_file)
+
+
+def run_cached(run_file, check_dir, check_env, run, tee=None):
+    """Run a check through the result cache if CHECK_CACHE_TTL is set.
+
+    Results are cached in CACHE_DIR by cache_key(). An identical check that
+    ran less than CHECK_CACHE_TTL ago is not run again, its run file and
+    status are reused. Identical checks starting at the same time wait for
+    the first one and reuse its result. Returns the exit code, the end time
+    and whether the result came from the cache.
+    """
+    ttl = checkerlib.parse_timespan(check_env.get('CHECK_CACHE_TTL'), 0)
+    if ttl <= 0:
+        return run() + (False,)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_file = os.path.join(CACHE_DIR, f"{cache_key(check_dir, check_env)}.out")
+    with open(f"{cache_file}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        status = checkerlib.read_status(cache_file)
+        age = time() - float(status['End']) if status else None
+        if age is not None and 0 <= age < ttl:
+            try:
+                # Run files are replaced, never written in place, so sharing the inode is safe
+                link_into_place(cache_file, run_file)
+            except FileNotFoundError:
+                pass
+            else:
+                fields = {key: value for key, value in status.items() if key != 'Checker-Status'}
+                fields['Cache-Age'] = f"{age:.3f}"
+                checkerlib.write_status(run_file, fields)
+                if tee:
+                    with open(run_file, 'rb') as f:
+                        tee.write(f.read())
+                    tee.flush()
+                return int(status['Exit-Code']), time(), True
+
+        exit_code, end = run()
+        try:
+            link_into_place(run_file, cache_file)
+            status = checkerlib.read_status(run_file)
+            checkerlib.write_status(cache_file, {key: value for key, value in status.items()
+                                                 if key != 'Checker-Status'})
+        except (OSError, AttributeError) as e:
+            print(f"Error caching result of {check_dir}: {e}", file=sys.stderr)
+        return exit_code, end, False
+
+
+def record_perfdata(check_id, run_file, env, timestamp):
+    """Append the performance data of a run to the check's metric rings.
+
+    Failures are logged, they must not keep the result from being notified.
+    """
+    retention = checkerlib.parse_number(env.get('CHECK_METRICS_RETENTION'), 1440, int)
+    if retention <= 0:
+        return
+    downsample_step = int(checkerlib.parse_timespan(env.get('CHECK_METRICS_DOWNSAMPLE'), 300))
+    downsample_retention = checkerlib.parse_number(env.get('CHECK_METRICS_DOWNSAMPLE_RETENTION'), 2016, int)
+
+    try:
+        with open(run_file, 'r', errors='replace') as f:
+            metrics = checkerlib.parse_perfdata(f.read())
+        checkerlib.record_metrics(METRICS_DIR, check_id, metrics, timestamp, retention,
+                                  downsample_step, downsample_retention)
+    except Exception as e:
+        print(f"Error recording metrics of {check_id}: {e}", file=sys.stderr)
+
+
+def record_history(check_id, run_file, exit_code, end):
+    """Append the result of a run to the history log."""
+    retention = checkerlib.parse_number(os.environ.get('CHECKER_HISTORY_DAYS'), 8, int)
+    if retention <= 0:
+        return
+    status = checkerlib.read_status(run_file) or {}
+    try:
+        checkerlib.History().append(check_id, end, float(status.get('Duration', 0)), exit_code,
+                                    retention_days=retention)
+    except (OSError, ValueError) as e:
+        print(f"Error recording history of {check_id}: {e}", file=sys.stderr)
+
+
+def load_notify():
+    """Import notify.py so the scheduler can dispatch notifications in-process."""
+    spec = importlib.util.spec_from_file_location('notify', NOTIFY_CMD)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_check(check_id, check, notify=None):
+    """Run a single check.sh like checker@.service would and notify."""
+    run_file = os.path.join(RUN_DIR, f"{check_id}.out")
+    env = dict(os.environ, PATH=CHECK_PATH)
+    env.update(check['env'])
+    timeout = checkerlib.parse_timespan(check['env'].get('CHECK_TIMEOUT'), None)
+    stages = {}
+
+    root, reason = unreachable(check_id, check['env'])
+    if root:
+        print(f"Skipping {check_id}: {reason}")
+        record_unreachable(run_file, root)
+        return checkerlib.UNREACHABLE_EXIT_CODE
+    slot, reason = admit(check['env'])
+    if reason:
+        print(f"Deferring {check_id}: {reason}")
+        record_deferred(run_file, reason)
+        return checkerlib.DEFERRED_EXIT_CODE
+    try:
+        exit_code, end, cached = run_cached(run_file, check['dir'], check['env'], lambda: execute_check(
+            run_file, check['env'], timeout,
+            stages=stages,
+            cwd=check['dir'],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+            limits=limit_resources(check['env'])
+        ))
+    finally:
+        if slot:
+            slot.close()
+    if not cached:
+        # A cached result was recorded when it ran
+        started = monotonic()
+        record_perfdata(check_id, run_file, env, end)
+        stages['perfdata'] = stage(started)
+        started = monotonic()
+        record_history(check_id, run_file, exit_code, end)
+        stages['history'] = stage(started)
+        checkerlib.record_stages(check_id, run_file, stages, merge=False)
+
+    started = monotonic()
+    if notify:
+        notify.dispatch(socket.gethostname(), check_id, str(exit_code), run_file, env)
+        stages = {'notify': stage(started)}
+    else:
+        # Same invocation as ExecStopPost in checker@.service
+        process = subprocess.Popen(
+            [NOTIFY_CMD, socket.gethostname(), check_id, run_file],
+            env=dict(env, EXIT_CODE='exited', EXIT_STATUS=str(exit_code)),
+            stdin=subprocess.DEVNULL
+        )
+        _, wait_status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(wait_status)
+        stages = {'notify': stage(started, rusage, exit_code=process.returncode)}
+    checkerlib.record_stages(check_id, run_file, stages)
+    return exit_code
+
+
+def scheduler():
+    """Run all checks from one process, rescheduling each after it finished."""
+    workers = int(os.environ.get('CHECKER_WORKERS', '4'))
+    randomized_delay = checkerlib.parse_timespan(os.environ.get('CHECKER_RANDOMIZED_DELAY'), 15)
+    os.makedirs(RUN_DIR, exist_ok=True)
+
+    # notify.py and its notifier plugins are loaded once and called in-process
+    notify = load_notify() if os.path.basename(NOTIFY_CMD) == 'notify.py' else None
+    if not SYSTEMD_RUN:
+        print("Warning: systemd is not running, CHECK_MEMORY_MAX limits the address space "
+              "and CHECK_CPU_QUOTA is not applied", file=sys.stderr)
+
+    state = {'reload': True, 'stop': False}
+    signal.signal(signal.SIGHUP, lambda *_: state.update(reload=True))
+    signal.signal(signal.SIGTERM, lambda *_: state.update(stop=True))
+    signal.signal(signal.SIGINT, lambda *_: state.update(stop=True))
+
+    checks = {}
+    checks_mtime = None
+    timers = []
+    running = set()
+    # Due checks held back until their due or running parents finished
+    waiting = set()
+    finished = queue.Queue()
+
+    # Last exit code, interval and next run of each check, kept across restarts
+    db = open_schedule()
+    schedule = {row[0]: row[1:] for row in db.execute(
+        "SELECT check_id, exit_code, interval, next_run FROM schedule")}
+
+    def done(check_id, future):
+        finished.put((check_id, future))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while not state['stop']:
+            # Pick up added or removed check directories and a recompiled registry
+            mtime = []
+            for path in (CHECKS_DIR, checkerlib.REGISTRY_FILE):
+                try:
+                    mtime.append(os.stat(path).st_mtime)
+                except OSError:
+                    mtime.append(None)
+            if state['reload'] or mtime != checks_mtime:
+                state['reload'] = False
+                checks_mtime = mtime
+                scheduled = {check_id for _, check_id in timers} | running | waiting
+                checks = load_checks()
+                now = monotonic()
+                for check_id, check in checks.items():
+                    if check_id in scheduled:
+                        continue
+                    if check_id in schedule:
+                        # Continue where the previous scheduler left off
+                        delay = min(max(schedule[check_id][2] - time(), 0), check['interval_max'])
+                    else:
+                        delay = random.uniform(0, min(check['interval'], randomized_delay))
+                    heapq.heappush(timers, (now + delay, check_id))
+                print(f"Scheduling {len(checks)} checks with {workers} workers")
+
+            # Start every check that is due, children only after their parents
+            now = monotonic()
+            while timers and timers[0][0] <= now:
+                _, check_id = heapq.heappop(timers)
+                if check_id in checks and check_id not in running:
+                    waiting.add(check_id)
+            for check_id in sorted(waiting):
+                if check_id not in checks:
+                    waiting.discard(check_id)
+                    continue
+                if any(parent in running or parent in waiting for parent in checks[check_id]['depends']):
+                    continue
+                waiting.discard(check_id)
+                running.add(check_id)
+                future = executor.submit(run_check, check_id, checks[check_id], notify)
+                future.add_done_callback(lambda f, c=check_id: done(c, f))
+
+            # Sleep until the next check is due or a running one finished
+            timeout = min(timers[0][0] - now, 5) if timers else 5
+            try:
+                check_id, future = finished.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                continue
+            running.discard(check_id)
+            try:
+                exit_code = future.result()
+            except Exception as e:
+                print(f"Error running check {check_id}: {e}", file=sys.stderr)
+                exit_code = 3
+            if check_id not in checks:
+                continue
+            if exit_code in (checkerlib.DEFERRED_EXIT_CODE, checkerlib.UNREACHABLE_EXIT_CODE):
+                # Retry soon without counting the deferral or the outage of a parent as a result
+                heapq.heappush(timers, (monotonic() + checks[check_id]['interval_min'], check_id))
+                continue
+
+            previous = schedule.get(check_id)
+            interval = next_interval(checks[check_id], exit_code, previous and previous[:2])
+            if interval != (previous[1] if previous else checks[check_id]['interval']):
+                print(f"Running {check_id} every {interval:g}s")
+            schedule[check_id] = (exit_code, interval, time() + interval)
+            try:
+                db.execute("INSERT OR REPLACE INTO schedule VALUES (?, ?, ?, ?)",
+                           (check_id, *schedule[check_id]))
+            except sqlite3.Error as e:
+                print(f"Error saving schedule of {check_id}: {e}", file=sys.stderr)
+            heapq.heappush(timers, (monotonic() + interval, check_id))
+
+        print("Stopping scheduler, waiting for running checks")
+    db.close()
 
 
 def main():
     # Ensure required variables are set
     if len(sys.argv) < 2:
-        print("Error: Usage: checker.py <run_file>", file=sys.stderr)
+        print("Error: Usage: checker.py <run_file> | checker.py scheduler | checker.py compile",
+              file=sys.stderr)
         sys.exit(9)
-    
+
+    if sys.argv[1] == 'scheduler':
+        scheduler()
+        sys.exit(0)
+    if sys.argv[1] == 'compile':
+        sys.exit(compile_registry())
+
     run_file = sys.argv[1]
-    
-    # Run check.sh and capture output
-    with open(run_file, 'w') as output_file:
-        process = subprocess.Popen(
-            ['./check.sh'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True
-        )
-        
-        # Tee output to both file and stdout
-        for line in process.stdout:
-            sys.stdout.write(line)
-            sys.stdout.flush()
-            output_file.write(line)
-            output_file.flush()
-        
-        # Wait for process to complete and get exit code
-        exit_code = process.wait()
-    
+    check_env = dict(load_env('check.env'), CHECK_CACHE_TTL=os.environ.get('CHECK_CACHE_TTL', ''))
+    check_id = os.path.splitext(os.path.basename(run_file))[0]
+
+    # Skip checks behind a CRITICAL parent, its notification covers the outage
+    root, reason = unreachable(check_id, check_env)
+    if root:
+        print(f"CHECK UNREACHABLE - {reason}")
+        record_unreachable(run_file, root)
+        sys.exit(checkerlib.UNREACHABLE_EXIT_CODE)
+
+    # Leave the host alone while it is saturated, notify.sh and notify.py skip deferred runs
+    slot, reason = admit(check_env)
+    if reason:
+        print(f"CHECK DEFERRED - {reason}")
+        record_deferred(run_file, reason)
+        sys.exit(checkerlib.DEFERRED_EXIT_CODE)
+
+    # Run check.sh and tee its output to both the run file and stdout
+    stages = {}
+    exit_code, end, cached = run_cached(
+        run_file, os.getcwd(), check_env,
+        lambda: execute_check(run_file, os.environ, tee=sys.stdout.buffer, stages=stages),
+        tee=sys.stdout.buffer
+    )
+    if slot:
+        slot.close()
+    if not cached:
+        # A cached result was recorded when it ran
+        started = monotonic()
+        record_perfdata(check_id, run_file, os.environ, end)
+        stages['perfdata'] = stage(started)
+        started = monotonic()
+        record_history(check_id, run_file, exit_code, end)
+        stages['history'] = stage(started)
+        checkerlib.record_stages(check_id, run_file, stages, merge=False)
+
     sys.exit(exit_code)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
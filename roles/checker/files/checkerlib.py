@@ -0,0 +1,793 @@
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+"""Helpers shared by the checker scripts and notifiers in /etc/checker."""
+
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import fcntl
+import ctypes
+import select
+import shutil
+import socket
+import struct
+import sqlite3
+import calendar
+import threading
+import collections
+import urllib.parse
+
+
+# Units of systemd.time(7) time spans in seconds, a number without unit is seconds
+TIMESPAN_UNITS = {
+    '': 1,
+    **dict.fromkeys(('us', 'usec', '\u00b5s'), 1e-6),
+    **dict.fromkeys(('ms', 'msec'), 1e-3),
+    **dict.fromkeys(('s', 'sec', 'second', 'seconds'), 1),
+    **dict.fromkeys(('m', 'min', 'minute', 'minutes'), 60),
+    **dict.fromkeys(('h', 'hr', 'hour', 'hours'), 3600),
+    **dict.fromkeys(('d', 'day', 'days'), 86400),
+    **dict.fromkeys(('w', 'week', 'weeks'), 7 * 86400),
+    **dict.fromkeys(('M', 'month', 'months'), 30.44 * 86400),
+    **dict.fromkeys(('y', 'year', 'years'), 365.25 * 86400),
+}
+TIMESPAN_PART_RE = re.compile(r'(\d+(?:\.\d*)?|\.\d+)\s*([^\d\s.]*)')
+TIMESPAN_RE = re.compile(r'(?:(?:\d+(?:\.\d*)?|\.\d+)\s*[^\d\s.]*\s*)+')
+
+
+def timespan_seconds(value):
+    """Convert a systemd time span like 30, 5min, 100ms or 1h 30min into seconds.
+
+    Raises ValueError for anything systemd.time(7) would not accept.
+    """
+    value = value.strip()
+    if not TIMESPAN_RE.fullmatch(value):
+        raise ValueError(f"invalid time span: {value!r}")
+    seconds = 0.0
+    for number, unit in TIMESPAN_PART_RE.findall(value):
+        if unit not in TIMESPAN_UNITS:
+            raise ValueError(f"unknown time unit {unit!r} in {value!r}")
+        seconds += float(number) * TIMESPAN_UNITS[unit]
+    return seconds
+
+
+def parse_timespan(value, default):
+    """Convert a systemd time span into seconds, default if it is empty or invalid."""
+    if not (value or '').strip():
+        return default
+    try:
+        return timespan_seconds(value)
+    except ValueError as e:
+        print(f"Warning: {e}, using {default}", file=sys.stderr)
+        return default
+
+
+def parse_number(value, default, kind=float):
+    """Convert a numeric setting with kind, default if it is empty or invalid."""
+    if not (value or '').strip():
+        return default
+    try:
+        number = kind(value)
+        if number != number or number in (float('inf'), float('-inf')):
+            raise ValueError(value)
+        return number
+    except ValueError:
+        print(f"Warning: invalid number {value!r}, using {default}", file=sys.stderr)
+        return default
+
+
+STATE_DB = os.environ.get('CHECKER_STATE_DB', '/var/lib/checker/state.db')
+
+
+def open_state_db(path=None):
+    """Open the checker state database, creating its directory if needed."""
+    path = path or STATE_DB
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=10, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+def rate_limit(buckets, path=None):
+    """Take one token from each (key, limit, window) bucket if all have one.
+
+    Each bucket holds up to limit tokens and refills at limit per window
+    seconds. Buckets with a limit of 0 are unlimited. Returns False without
+    taking any token if one of the buckets is empty.
+    """
+    buckets = [(key, float(limit), float(window)) for key, limit, window in buckets
+               if float(limit) > 0]
+    if not buckets:
+        return True
+
+    now = time.time()
+    db = open_state_db(path)
+    try:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            " key TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated REAL NOT NULL)"
+        )
+        db.execute("BEGIN IMMEDIATE")
+        updates = []
+        for key, limit, window in buckets:
+            row = db.execute(
+                "SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = limit if row is None else min(limit, row[0] + (now - row[1]) * limit / window)
+            if tokens < 1:
+                db.execute("ROLLBACK")
+                return False
+            updates.append((key, tokens - 1, now))
+        db.executemany("INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)", updates)
+        db.execute("COMMIT")
+        return True
+    finally:
+        db.close()
+
+
+# Exit code of a check run deferred by admission control (EX_TEMPFAIL),
+# notifiers are not called for it
+DEFERRED_EXIT_CODE = 75
+
+# Exit code of a check run skipped because a CHECK_DEPENDS parent is CRITICAL,
+# notifiers are not called for it either
+UNREACHABLE_EXIT_CODE = 76
+
+
+# Fixed size of the <check_id>.status file written next to each run file
+STATUS_SIZE = 512
+STATUS_VERSION = 1
+
+
+def status_path(run_file):
+    """Path of the status file belonging to a run file."""
+    base, ext = os.path.splitext(run_file)
+    return (base if ext == '.out' else run_file) + '.status'
+
+
+def write_status(run_file, fields):
+    """Atomically write the status header for a run file.
+
+    The header is a fixed size block of "Key: value" lines, so readers get
+    exit code, timing and output metadata of a check with a single read
+    without touching the possibly large output.
+    """
+    lines = [f"Checker-Status: {STATUS_VERSION}"]
+    lines += [f"{key}: {value}" for key, value in fields.items()]
+    data = ('\n'.join(lines) + '\n').encode()
+    data = data[:STATUS_SIZE - 1].ljust(STATUS_SIZE - 1, b' ') + b'\n'
+
+    path = status_path(run_file)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, path)
+
+
+def read_status(run_file):
+    """Read the status header of a run file, None if there is none."""
+    try:
+        with open(status_path(run_file), 'rb') as f:
+            data = f.read(STATUS_SIZE)
+    except OSError:
+        return None
+
+    status = {}
+    for line in data.decode(errors='replace').splitlines():
+        key, sep, value = line.partition(': ')
+        if sep:
+            status[key] = value.strip()
+    if 'Checker-Status' not in status:
+        return None
+    return status
+
+
+REGISTRY_FILE = os.environ.get('CHECKER_REGISTRY', '/etc/checker/registry')
+REGISTRY_VERSION = 1
+
+# Registry of this process by path, reused while its mtime is unchanged
+_registry = {}
+
+
+class Registry:
+    """Configuration compiled by `checker.py compile`.
+
+    The first line is a JSON header with the version, the mtimes of the
+    directories and files the registry was compiled from, the notifiers and
+    the parsed notifier configurations. Each further line is a check id and
+    its JSON entry separated by a tab, so readers only decode what they use.
+    Check entries carry the file_stamp() of their check.env, which changes
+    when it is edited in place.
+    """
+
+    def __init__(self, data):
+        header, _, self.body = data.partition(b'\n')
+        self.header = json.loads(header)
+
+    def fresh(self, path):
+        """Whether path is unchanged since the registry was compiled."""
+        try:
+            return os.stat(path).st_mtime_ns == self.header['mtimes'].get(path)
+        except OSError:
+            return False
+
+    def check_ids(self):
+        return [line.partition(b'\t')[0].decode() for line in self.body.splitlines()]
+
+    def checks(self):
+        """Entries of all checks by check id, each with dir and env."""
+        checks = {}
+        for line in self.body.splitlines():
+            check_id, _, entry = line.partition(b'\t')
+            checks[check_id.decode()] = json.loads(entry)
+        return checks
+
+    def config(self, path):
+        """Parsed environment file of a notifier, None if it changed since compiling."""
+        if path not in self.header['configs'] or not self.fresh(path):
+            return None
+        return dict(self.header['configs'][path])
+
+
+def file_stamp(path):
+    """Modification time and size of a file as a list, None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def write_registry(header, checks, path=None):
+    """Atomically write a registry from its header and check entries."""
+    path = path or REGISTRY_FILE
+    lines = [json.dumps(dict(header, version=REGISTRY_VERSION), separators=(',', ':'))]
+    lines += [f"{check_id}\t{json.dumps(entry, separators=(',', ':'))}"
+              for check_id, entry in sorted(checks.items())]
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(tmp_file, 0o644)
+    os.replace(tmp_file, path)
+
+
+def read_registry(path=None):
+    """The registry, None if there is none or it has another version."""
+    path = path or REGISTRY_FILE
+    try:
+        with open(path, 'rb') as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            cached = _registry.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            registry = Registry(f.read())
+    except (OSError, ValueError):
+        return None
+    if registry.header.get('version') != REGISTRY_VERSION:
+        return None
+    _registry[path] = (mtime, registry)
+    return registry
+
+
+def registry_config(path):
+    """Notifier configuration from the registry, None if it has none or it is stale."""
+    registry = read_registry()
+    return registry.config(path) if registry else None
+
+
+JOURNAL_SOCKET = '/run/systemd/journal/socket'
+
+
+def journal_send(message, **fields):
+    """Log a structured entry using the journald native protocol.
+
+    Field names are upper cased, fields that are None are left out.
+    Returns False if journald is not available.
+    """
+    data = bytearray()
+    for key, value in [('MESSAGE', message)] + list(fields.items()):
+        if value is None:
+            continue
+        key = key.upper().encode()
+        value = str(value).encode()
+        if b'\n' in value:
+            data += key + b'\n' + struct.pack('<Q', len(value)) + value + b'\n'
+        else:
+            data += key + b'=' + value + b'\n'
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(data, JOURNAL_SOCKET)
+    except OSError:
+        return False
+    return True
+
+
+def timing_path(run_file):
+    """Path of the stage timing file belonging to a run file."""
+    return os.path.splitext(status_path(run_file))[0] + '.timing'
+
+
+def read_timing(run_file):
+    """Stage timings of the last run, an empty dict if there are none."""
+    try:
+        with open(timing_path(run_file), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_stages(check_id, run_file, stages, merge=True):
+    """Emit stage timings to the journal and the run file's timing file.
+
+    stages maps stage names to dicts of wall_seconds, cpu_seconds and
+    output_bytes. Without merge the timing file is
+    started over, so it only holds stages of the current run.
+    """
+    if os.environ.get('CHECKER_TIMING', 'true') != 'true' or not stages:
+        return
+    for stage, values in stages.items():
+        journal_send(
+            f"{check_id}: {stage} took {values['wall_seconds']:.3f}s",
+            SYSLOG_IDENTIFIER='checker',
+            CHECKER_CHECK_ID=check_id,
+            CHECKER_STAGE=stage,
+            **{f"CHECKER_{key}": value for key, value in values.items()}
+        )
+
+    timing = dict(read_timing(run_file), **stages) if merge else dict(stages)
+    path = timing_path(run_file)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(timing, f)
+        os.replace(tmp_file, path)
+    except OSError as e:
+        print(f"Error writing stage timings of {check_id}: {e}", file=sys.stderr)
+
+
+def targets_path(run_file):
+    """Path of the per-target results checker-probe.py leaves for notify.py."""
+    return os.path.splitext(status_path(run_file))[0] + '.targets'
+
+
+def write_targets(run_file, targets):
+    """Leave (target_id, exit_code, run_file) results to notify after the run."""
+    path = targets_path(run_file)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(targets, f)
+    os.replace(tmp_file, path)
+
+
+def take_targets(run_file):
+    """Claim the results left by write_targets(), an empty list if there are none.
+
+    The file is renamed before reading, so each result is notified once even
+    if notify.py runs twice for the same run file.
+    """
+    path = targets_path(run_file)
+    claimed = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        return []
+    try:
+        with open(claimed, 'r') as f:
+            return json.load(f)
+    finally:
+        os.unlink(claimed)
+
+
+# Label, value and unit followed by optional warn;crit;min;max
+PERFDATA_RE = re.compile(
+    r"('(?:[^']|'')+'|[^\s=']+)=([-+]?[\d.,]+|U)([^\s;\d]*)"
+    r"(?:;([^\s;]*))?(?:;([^\s;]*))?(?:;([^\s;]*))?(?:;([^\s;]*))?"
+)
+
+Metric = collections.namedtuple('Metric', 'label value uom warn crit min max')
+
+
+def parse_perfdata(output):
+    """Parse the Nagios performance data of a check output into metrics.
+
+    Performance data follows the first | of the first line and of the long
+    output. Values that are unknown ("U") are skipped, warn and crit are
+    kept as range strings.
+    """
+    first_line, _, long_output = output.partition('\n')
+    perfdata = first_line.partition('|')[2]
+    if '|' in long_output:
+        perfdata += ' ' + long_output.partition('|')[2]
+
+    def number(value):
+        try:
+            return float(value.replace(',', '.'))
+        except (AttributeError, ValueError):
+            return None
+
+    metrics = []
+    for label, value, uom, warn, crit, minimum, maximum in PERFDATA_RE.findall(perfdata):
+        if value == 'U' or number(value) is None:
+            continue
+        label = label[1:-1].replace("''", "'") if label.startswith("'") else label
+        metrics.append(Metric(label, number(value), uom, warn or None, crit or None,
+                              number(minimum), number(maximum)))
+    return metrics
+
+
+class MetricRing:
+    """Fixed size ring buffer of metric samples in a memory mapped file.
+
+    Raw rings store (timestamp, value) records. Rings with a step store one
+    (timestamp, average, min, max) record per step and keep the running
+    aggregate of the current step in the header.
+    """
+
+    MAGIC = b'CKRB'
+    VERSION = 1
+    # magic, version, record size, capacity, records written, step,
+    # current step start, sum, count, min, max
+    HEADER = struct.Struct('<4sHHIQdddQdd')
+    HEADER_SIZE = 128
+    RAW = struct.Struct('<dd')
+    DOWNSAMPLED = struct.Struct('<dddd')
+
+    def __init__(self, path, capacity, step=0):
+        record = self.DOWNSAMPLED if step else self.RAW
+        size = self.HEADER_SIZE + capacity * record.size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, self.HEADER.size, 0)
+            valid = False
+            if len(header) == self.HEADER.size and os.fstat(fd).st_size == size:
+                magic, version, record_size, file_capacity, _, file_step = self.HEADER.unpack(header)[:6]
+                valid = ((magic, version, record_size, file_capacity, file_step)
+                         == (self.MAGIC, self.VERSION, record.size, capacity, step))
+            if not valid:
+                # New file or changed retention, start over
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.VERSION, record.size, capacity,
+                                               0, step, 0, 0, 0, 0, 0), 0)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.record = record
+        self.capacity = capacity
+        self.step = step
+
+    def close(self):
+        self.map.close()
+
+    def _header(self):
+        return list(self.HEADER.unpack_from(self.map, 0))
+
+    def _append(self, header, *values):
+        offset = self.HEADER_SIZE + (header[4] % self.capacity) * self.record.size
+        self.record.pack_into(self.map, offset, *values)
+        header[4] += 1
+
+    def add(self, timestamp, value):
+        """Add a sample, for downsampled rings aggregated into its step."""
+        header = self._header()
+        if not self.step:
+            self._append(header, timestamp, value)
+        else:
+            bucket = timestamp - timestamp % self.step
+            count = header[8]
+            if count and bucket != header[6]:
+                # Close the previous step
+                self._append(header, header[6], header[7] / count, header[9], header[10])
+                count = 0
+            if not count:
+                header[6:11] = [bucket, value, 1, value, value]
+            else:
+                header[7:11] = [header[7] + value, count + 1,
+                                min(header[9], value), max(header[10], value)]
+        self.HEADER.pack_into(self.map, 0, *header)
+
+    def records(self):
+        """All stored records, oldest first."""
+        written = self._header()[4]
+        count = min(written, self.capacity)
+        records = []
+        for i in range(written - count, written):
+            offset = self.HEADER_SIZE + (i % self.capacity) * self.record.size
+            records.append(self.record.unpack_from(self.map, offset))
+        return records
+
+
+def record_metrics(metrics_dir, check_id, metrics, timestamp, retention,
+                   downsample_step=0, downsample_retention=0):
+    """Append parsed metrics of a check run to its per metric rings."""
+    for metric in metrics:
+        name = urllib.parse.quote(metric.label, safe='')
+        rings = [MetricRing(os.path.join(metrics_dir, check_id, f"{name}.ring"), retention)]
+        if downsample_step and downsample_retention:
+            rings.append(MetricRing(
+                os.path.join(metrics_dir, check_id, f"{name}.{downsample_step}s.ring"),
+                downsample_retention, downsample_step))
+        for ring in rings:
+            ring.add(timestamp, metric.value)
+            ring.close()
+
+
+HISTORY_DIR = os.environ.get('CHECKER_HISTORY_DIR', '/var/lib/checker/history')
+
+
+class History:
+    """Append-only log of check results, rotated into one segment per day (UTC).
+
+    Each segment directory holds two files:
+
+    - log: fixed size records in order of arrival, each linking to the
+      previous record of the same check in the segment
+    - index: one fixed size summary slot per check with runs, state
+      changes, durations, time spent in each state and the last record
+
+    Queries over all checks read one slot per check and day, queries of one
+    check follow its chain of records backwards from the slot. Checks are
+    numbered in the checks file shared by all segments.
+    """
+
+    # end, duration, check number, exit code, flags, previous record of the check
+    RECORD = struct.Struct('<dfIBBxxI')
+    # runs, state changes, last exit code, last record, first end, last end,
+    # total duration, max duration, end of the slowest run, seconds in OK,
+    # WARNING, CRITICAL and UNKNOWN
+    SLOT = struct.Struct('<IIiI5d4d')
+    NONE = 0xffffffff
+    FLAG_CACHED = 1
+    SEGMENT_SECONDS = 86400
+
+    def __init__(self, path=None):
+        self.path = path or HISTORY_DIR
+        self._numbers = {}
+
+    def segment_dir(self, day):
+        return os.path.join(self.path, time.strftime('%Y-%m-%d', time.gmtime(day * self.SEGMENT_SECONDS)))
+
+    def days(self, since=0, until=None):
+        """Days (since the epoch) of the existing segments overlapping since..until."""
+        days = []
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return days
+        for name in names:
+            try:
+                day = calendar.timegm(time.strptime(name, '%Y-%m-%d')) // self.SEGMENT_SECONDS
+            except ValueError:
+                continue
+            if (day + 1) * self.SEGMENT_SECONDS > since and (until is None or day * self.SEGMENT_SECONDS <= until):
+                days.append(day)
+        return sorted(days)
+
+    def checks(self):
+        """Check ids by number."""
+        try:
+            with open(os.path.join(self.path, 'checks'), 'r') as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def number(self, check_id):
+        """Number of a check, assigning the next one to a new check."""
+        if check_id not in self._numbers:
+            checks = self.checks()
+            if check_id not in checks:
+                os.makedirs(self.path, exist_ok=True)
+                with open(os.path.join(self.path, 'checks'), 'a+') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    f.seek(0)
+                    checks = f.read().splitlines()
+                    if check_id not in checks:
+                        f.write(f"{check_id}\n")
+                        checks.append(check_id)
+            self._numbers = {name: number for number, name in enumerate(checks)}
+        return self._numbers[check_id]
+
+    def read_slot(self, day, number):
+        """Summary slot of a check in a segment, None if it has none."""
+        try:
+            with open(os.path.join(self.segment_dir(day), 'index'), 'rb') as f:
+                f.seek(number * self.SLOT.size)
+                data = f.read(self.SLOT.size)
+        except FileNotFoundError:
+            return None
+        if len(data) < self.SLOT.size or not self.SLOT.unpack(data)[0]:
+            return None
+        return self.SLOT.unpack(data)
+
+    def append(self, check_id, end, duration, exit_code, flags=0, retention_days=8):
+        """Add the result of a check run."""
+        exit_code &= 0xff
+        number = self.number(check_id)
+        day = int(end // self.SEGMENT_SECONDS)
+        segment = self.segment_dir(day)
+        if not os.path.isdir(segment):
+            os.makedirs(segment, exist_ok=True)
+            self.prune(day - retention_days + 1)
+
+        index_fd = os.open(os.path.join(segment, 'index'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # One writer per segment at a time keeps records and slots consistent
+            fcntl.flock(index_fd, fcntl.LOCK_EX)
+            data = os.pread(index_fd, self.SLOT.size, number * self.SLOT.size)
+            slot = list(self.SLOT.unpack(data)) if len(data) == self.SLOT.size else [0] * 13
+            if not slot[0]:
+                # First run of the day, continue from the last state of the previous day
+                previous = self.read_slot(day - 1, number)
+                slot = [0, 0, previous[2] if previous else -1, self.NONE, end,
+                        previous[5] if previous else 0, 0, 0, 0, 0, 0, 0, 0]
+            runs, changes, last_exit, last_record, first_end, last_end = slot[:6]
+
+            log_fd = os.open(os.path.join(segment, 'log'), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                record = os.fstat(log_fd).st_size // self.RECORD.size
+                os.write(log_fd, self.RECORD.pack(end, duration, number, exit_code & 0xff, flags, last_record))
+            finally:
+                os.close(log_fd)
+
+            if last_exit >= 0:
+                changes += exit_code != last_exit
+                if last_end:
+                    slot[9 + (last_exit if last_exit <= 3 else 3)] += max(end - last_end, 0)
+            slot[:6] = runs + 1, changes, exit_code, record, first_end, end
+            slot[6] += duration
+            if duration >= slot[7]:
+                slot[7], slot[8] = duration, end
+            os.pwrite(index_fd, self.SLOT.pack(*slot), number * self.SLOT.size)
+        finally:
+            os.close(index_fd)
+
+    def prune(self, first_day):
+        """Remove segments of days before first_day."""
+        for day in self.days(0, first_day * self.SEGMENT_SECONDS - 1):
+            shutil.rmtree(self.segment_dir(day), ignore_errors=True)
+
+    def summaries(self, since=0, until=None):
+        """Summaries of all checks over the segments overlapping since..until."""
+        checks = self.checks()
+        summaries = {}
+        for day in self.days(since, until):
+            try:
+                with open(os.path.join(self.segment_dir(day), 'index'), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            data = data[:len(data) - len(data) % self.SLOT.size]
+            for number, slot in enumerate(self.SLOT.iter_unpack(data)):
+                if not slot[0] or number >= len(checks):
+                    continue
+                summary = summaries.get(checks[number])
+                if summary is None:
+                    summary = summaries[checks[number]] = {
+                        'runs': 0, 'changes': 0, 'first_end': slot[4], 'total_duration': 0.0,
+                        'max_duration': 0.0, 'max_end': 0.0, 'state_seconds': [0.0] * 4}
+                summary['runs'] += slot[0]
+                summary['changes'] += slot[1]
+                summary['exit_code'] = slot[2]
+                summary['last_end'] = slot[5]
+                summary['total_duration'] += slot[6]
+                if slot[7] >= summary['max_duration']:
+                    summary['max_duration'], summary['max_end'] = slot[7], slot[8]
+                for state in range(4):
+                    summary['state_seconds'][state] += slot[9 + state]
+        return summaries
+
+    def records(self, check_id, since=0, until=None):
+        """Results of one check as (end, duration, exit code, flags), oldest first."""
+        checks = self.checks()
+        if check_id not in checks:
+            return []
+        number = checks.index(check_id)
+        results = []
+        for day in reversed(self.days(since, until)):
+            slot = self.read_slot(day, number)
+            if slot is None:
+                continue
+            try:
+                # Mapped, so only the pages holding records of this check are read
+                with open(os.path.join(self.segment_dir(day), 'log'), 'rb') as f:
+                    log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                continue
+            with log:
+                record = slot[3]
+                while record != self.NONE and (record + 1) * self.RECORD.size <= len(log):
+                    end, duration, _, exit_code, flags, record = self.RECORD.unpack_from(
+                        log, record * self.RECORD.size)
+                    if end < since:
+                        # Older segments only hold older results
+                        results.reverse()
+                        return results
+                    if until is None or end <= until:
+                        results.append((end, duration, exit_code, flags))
+        results.reverse()
+        return results
+
+    def recent(self, limit=10):
+        """Latest results of all checks as (check id, end, duration, exit code, flags), newest first."""
+        checks = self.checks()
+        results = []
+        for day in reversed(self.days()):
+            try:
+                with open(os.path.join(self.segment_dir(day), 'log'), 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size // self.RECORD.size * self.RECORD.size
+                    count = min(limit - len(results), size // self.RECORD.size)
+                    f.seek(size - count * self.RECORD.size)
+                    data = f.read(count * self.RECORD.size)
+            except FileNotFoundError:
+                continue
+            for end, duration, number, exit_code, flags, _ in reversed(list(self.RECORD.iter_unpack(data))):
+                check_id = checks[number] if number < len(checks) else str(number)
+                results.append((check_id, end, duration, exit_code, flags))
+            if len(results) >= limit:
+                break
+        return results
+
+
+class Inotify:
+    """Minimal inotify(7) binding, to follow changes of the run directory."""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Watch path for the events in mask, returns the watch descriptor."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events, returns (wd, mask, name) tuples."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
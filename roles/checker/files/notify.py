@@ -5,81 +5,456 @@
 import os
 import sys
 import glob
-import subprocess
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+import sqlite3
+import resource
+import asyncio
+import threading
+import importlib.util
 
+import checkerlib
 
-def run_notifier(script, hostname, check_id, exit_code, run_file_content):
-    """Run a single notifier script and return its exit code."""
+
+NOTIFIERS_DIR = os.environ.get('CHECKER_NOTIFIERS_DIR', '/etc/checker/notifiers')
+
+# Set when running as ExecStopPost, where all children are our notifiers
+_standalone = False
+
+# Loaded notifier plugins by path, reused while their mtime is unchanged
+_plugins = {}
+_plugins_lock = threading.Lock()
+
+
+def load_plugin(path):
+    """Import a notifier plugin once and return its notify() callable."""
+    mtime = os.stat(path).st_mtime
+    with _plugins_lock:
+        cached = _plugins.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        name = 'checker_notifier_' + os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if not callable(getattr(module, 'notify', None)):
+            raise ImportError(f"{path} has no notify() function")
+
+        _plugins[path] = (mtime, module.notify)
+        return module.notify
+
+
+def open_state():
+    """Open the per-check state store, creating it if needed."""
+    db = checkerlib.open_state_db()
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS checks ("
+        " check_id TEXT PRIMARY KEY,"
+        " exit_code INTEGER NOT NULL,"
+        " first_seen REAL NOT NULL,"
+        " last_run REAL NOT NULL,"
+        " last_notified REAL)"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS flapping ("
+        " check_id TEXT PRIMARY KEY,"
+        " changes INTEGER NOT NULL,"
+        " flapping INTEGER NOT NULL,"
+        " percent REAL NOT NULL)"
+    )
+    return db
+
+
+def state_change_percent(changes, window):
+    """Weighted percent state change of the last window results.
+
+    changes has a bit set for each of the window - 1 transitions between
+    them that changed the state, the newest in bit 0. Like Nagios, recent
+    changes weigh up to 1.2 and the oldest 0.8, so a check changing its
+    state on every run is at 100%.
+    """
+    transitions = window - 1
+    total = 0.0
+    for age in range(transitions):
+        if changes >> age & 1:
+            total += 0.8 + 0.4 * (transitions - 1 - age) / max(transitions - 1, 1)
+    return 100 * total / transitions
+
+
+def update_flapping(db, check_id, changed, env):
+    """Add a result to the flap history of a check.
+
+    A check starts flapping when its state change percent reaches
+    NOTIFY_FLAP_HIGH and stops once it drops below NOTIFY_FLAP_LOW.
+    Returns whether it is flapping, 'start', 'stop' or None, and the
+    percent.
+    """
+    window = min(max(checkerlib.parse_number(env.get('NOTIFY_FLAP_HISTORY'), 21, int), 2), 63)
+    low = checkerlib.parse_number(env.get('NOTIFY_FLAP_LOW'), 20)
+    high = checkerlib.parse_number(env.get('NOTIFY_FLAP_HIGH'), 30)
+
+    row = db.execute("SELECT changes, flapping FROM flapping WHERE check_id = ?", (check_id,)).fetchone()
+    changes, flapping = row or (0, 0)
+    changes = (changes << 1 | changed) & ((1 << (window - 1)) - 1)
+    percent = state_change_percent(changes, window)
+
+    event = None
+    if not flapping and percent >= high:
+        flapping, event = 1, 'start'
+    elif flapping and percent < low:
+        flapping, event = 0, 'stop'
+    db.execute("INSERT OR REPLACE INTO flapping VALUES (?, ?, ?, ?)",
+               (check_id, changes, flapping, percent))
+    return bool(flapping), event, percent
+
+
+def update_state(check_id, exit_code, env):
+    """Record a check result and decide whether the notifiers should run.
+
+    Returns whether to notify and, while the check is flapping or when it
+    started or stopped flapping, the flap event ('start', 'stop' or None)
+    and state change percent.
+    """
+    change_only = env.get('NOTIFY_ON_CHANGE_ONLY', 'false') == 'true'
+    renotify = checkerlib.parse_timespan(env.get('NOTIFY_RENOTIFY_INTERVAL'), 0)
+    exit_code = int(exit_code) if str(exit_code).isdigit() else 3
+    now = time.time()
+
+    db = open_state()
     try:
-        print(f"Notifying with {script}")
-        process = subprocess.Popen(
-            [script, hostname, check_id, str(exit_code)],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            "SELECT exit_code, first_seen, last_notified FROM checks WHERE check_id = ?",
+            (check_id,)
+        ).fetchone()
+
+        if row is None:
+            # A check starting out OK is not worth a notification
+            changed = exit_code != 0
+            first_seen, last_notified = now, None
+        else:
+            changed = row[0] != exit_code
+            first_seen = now if changed else row[1]
+            last_notified = row[2]
+
+        flap = None
+        if env.get('NOTIFY_FLAP_DETECTION', 'false') == 'true':
+            flapping, event, percent = update_flapping(db, check_id, row is not None and changed, env)
+            if flapping or event:
+                flap = (event, percent)
+
+        if flap:
+            # One alert when flapping starts and stops, nothing in between
+            notify = flap[0] is not None
+        elif not change_only or changed:
+            notify = True
+        else:
+            # Remind about persistent problems every renotify interval
+            notify = (exit_code != 0 and renotify > 0
+                      and now - (last_notified or first_seen) >= renotify)
+
+        db.execute(
+            "INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?)",
+            (check_id, exit_code, first_seen, now, now if notify else last_notified)
         )
-        stdout, stderr = process.communicate(input=run_file_content)
-        
-        if stdout:
-            print(stdout, end='')
-        if stderr:
-            print(stderr, end='', file=sys.stderr)
-            
-        if process.returncode != 0:
-            print(f"A notifier ({script}) failed with exit code {process.returncode}")
-            return 8
+        db.execute("COMMIT")
+        return notify, flap
+    finally:
+        db.close()
+
+
+def within_rate_limit(notifier, hostname, check_id, env):
+    """Apply the NOTIFY_RATE_LIMIT* limits shared by all notifiers."""
+    name = os.path.splitext(os.path.basename(notifier))[0]
+    window = env.get('NOTIFY_RATE_WINDOW', '3600')
+    buckets = [
+        (f"notify:{name}:check:{check_id}", env.get('NOTIFY_RATE_LIMIT', '0'), window),
+        (f"notify:{name}:host:{hostname}", env.get('NOTIFY_RATE_LIMIT_HOST', '0'), window),
+        (f"notify:{name}:global", env.get('NOTIFY_RATE_LIMIT_GLOBAL', '0'), window),
+    ]
+    try:
+        if checkerlib.rate_limit(buckets):
+            return True
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error checking rate limit, notifying anyway: {e}", file=sys.stderr)
+        return True
+    print(f"Rate limit exceeded for {notifier} ({check_id} on {hostname})")
+    return False
+
+
+def find_notifiers():
+    """Find all notifier plugins and executable notifier scripts."""
+    registry = checkerlib.read_registry()
+    if registry and registry.fresh(NOTIFIERS_DIR):
+        return registry.header['plugins'], registry.header['scripts']
+
+    plugins = sorted(glob.glob(os.path.join(NOTIFIERS_DIR, '*.py')))
+    scripts = []
+    for script in sorted(glob.glob(os.path.join(NOTIFIERS_DIR, '*.sh'))):
+        if os.path.isfile(script) and os.access(script, os.X_OK):
+            scripts.append(script)
+    return plugins, scripts
+
+
+def notifier_stage(path, started, exit_code, output_bytes=None, cpu_seconds=None):
+    """Timing record of one notifier run started at the monotonic time started."""
+    record = {'wall_seconds': round(time.monotonic() - started, 6), 'exit_code': exit_code}
+    if cpu_seconds is not None:
+        record['cpu_seconds'] = round(cpu_seconds, 6)
+    if output_bytes is not None:
+        record['output_bytes'] = output_bytes
+    return f"notifier:{os.path.basename(path)}", record
+
+
+def call_plugin(notify, *args):
+    """Call a plugin, returns its result and the CPU time it used."""
+    started = time.thread_time()
+    result = notify(*args)
+    return result, time.thread_time() - started
+
+
+def run_in_thread(function, *args):
+    """Run function in a daemon thread, returns a future of its result.
+
+    Unlike the default executor of the event loop, the thread is not waited
+    for when the loop is closed, so a plugin that hangs past its timeout is
+    abandoned instead of holding up the dispatch.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        # The future is cancelled once the plugin timed out
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            result, error = function(*args), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            # The loop is closed, nobody waits for this plugin any more
+            pass
+
+    threading.Thread(target=target, name=f"notifier-{function.__name__}", daemon=True).start()
+    return future
+
+
+async def run_plugin(path, hostname, check_id, exit_code, output, limit, timeout, stages):
+    """Call a notifier plugin in-process and return 8 if it failed."""
+    async with limit:
+        started = time.monotonic()
+        cpu_seconds = None
+        result = 8
+        try:
+            print(f"Notifying with {path}")
+            notify = load_plugin(path)
+            status = int(exit_code) if str(exit_code).isdigit() else 3
+            outcome, cpu_seconds = await asyncio.wait_for(
+                run_in_thread(call_plugin, notify, hostname, check_id, status, output),
+                timeout
+            )
+            if outcome is False:
+                print(f"A notifier ({path}) failed")
+                return result
+            result = 0
+            return result
+        except asyncio.TimeoutError:
+            print(f"A notifier ({path}) timed out after {timeout:g}s, abandoning it", file=sys.stderr)
+            return result
+        except Exception as e:
+            print(f"Error running notifier {path}: {e}", file=sys.stderr)
+            return result
+        finally:
+            name, record = notifier_stage(path, started, result, cpu_seconds=cpu_seconds)
+            stages[name] = record
+
+
+async def run_notifier(script, hostname, check_id, exit_code, run_file, limit, timeout, stages,
+                       message=None):
+    """Run a single notifier script and return its exit code.
+
+    The script reads the run file, or message instead if given.
+    """
+    async with limit:
+        started = time.monotonic()
+        output_bytes = None
+        result = 8
+        try:
+            print(f"Notifying with {script}")
+            # Each notifier reads the run file through its own descriptor
+            stdin = open(run_file, 'rb') if message is None else asyncio.subprocess.PIPE
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    script, hostname, check_id, str(exit_code),
+                    stdin=stdin,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            finally:
+                if message is None:
+                    stdin.close()
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(None if message is None else message.encode()), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                print(f"A notifier ({script}) timed out after {timeout:g}s", file=sys.stderr)
+                return result
+
+            output_bytes = len(stdout) + len(stderr)
+            if stdout:
+                print(stdout.decode(errors='replace'), end='')
+            if stderr:
+                print(stderr.decode(errors='replace'), end='', file=sys.stderr)
+
+            if process.returncode != 0:
+                print(f"A notifier ({script}) failed with exit code {process.returncode}")
+                return result
+            result = 0
+            return result
+        except Exception as e:
+            print(f"Error running notifier {script}: {e}", file=sys.stderr)
+            return result
+        finally:
+            name, record = notifier_stage(script, started, result, output_bytes)
+            stages[name] = record
+
+
+async def run_notifiers(plugins, scripts, hostname, check_id, exit_code, run_file, env, stages,
+                        message=None):
+    """Run all notifiers concurrently and return 8 if any of them failed.
+
+    Notifiers get message instead of the run file if given. The timing of
+    each notifier is added to stages.
+    """
+    limit = asyncio.Semaphore(max(checkerlib.parse_number(env.get('NOTIFY_CONCURRENCY'), 8, int), 1))
+    timeout = checkerlib.parse_timespan(env.get('NOTIFY_TIMEOUT'), 60)
+
+    plugins = [path for path in plugins if within_rate_limit(path, hostname, check_id, env)]
+    scripts = [script for script in scripts if within_rate_limit(script, hostname, check_id, env)]
+
+    output = message or ''
+    if plugins and message is None:
+        with open(run_file, 'r', errors='replace') as f:
+            output = f.read()
+
+    results = await asyncio.gather(
+        *(run_plugin(path, hostname, check_id, exit_code, output, limit, timeout, stages)
+          for path in plugins),
+        *(run_notifier(script, hostname, check_id, exit_code, run_file, limit, timeout, stages, message)
+          for script in scripts)
+    )
+    return max(results, default=0)
+
+
+def dispatch(hostname, check_id, exit_code, run_file, env=None):
+    """Notify all notifiers about a check result, returns the exit code.
+
+    Per-target results checker-probe.py left for the run file are notified
+    afterwards, each like a check of its own.
+    """
+    env = os.environ if env is None else env
+    result = notify_check(hostname, check_id, exit_code, run_file, env)
+    try:
+        targets = checkerlib.take_targets(run_file)
+    except (OSError, ValueError) as e:
+        print(f"Error reading target results of {check_id}: {e}", file=sys.stderr)
+        return max(result, 1)
+    for target_id, target_exit_code, target_run_file in targets:
+        result = max(result, notify_check(hostname, target_id, str(target_exit_code),
+                                          target_run_file, env))
+    return result
+
+
+def notify_check(hostname, check_id, exit_code, run_file, env):
+    """Notify all notifiers about the result of one check, returns the exit code."""
+    if exit_code == str(checkerlib.DEFERRED_EXIT_CODE):
+        print(f"Check {check_id} was deferred, not notifying")
+        return 0
+    if exit_code == str(checkerlib.UNREACHABLE_EXIT_CODE):
+        print(f"Check {check_id} is unreachable, not notifying")
+        return 0
+
+    # Make sure the run file is readable before starting any notifier
+    if not os.access(run_file, os.R_OK):
+        print(f"Error reading run file: {run_file}", file=sys.stderr)
+        return 1
+
+    stages = {}
+    started = time.monotonic()
+    try:
+        notify, flap = update_state(check_id, exit_code, env)
+    except sqlite3.Error as e:
+        print(f"Error updating check state, notifying anyway: {e}", file=sys.stderr)
+        notify, flap = True, None
+    stages['state'] = {'wall_seconds': round(time.monotonic() - started, 6)}
+    if not notify:
+        if flap:
+            print(f"{check_id} is flapping ({flap[1]:.1f}% state change), not notifying")
+        else:
+            print(f"State of {check_id} unchanged, not notifying")
+        checkerlib.record_stages(check_id, run_file, stages)
         return 0
-    except Exception as e:
-        print(f"Error running notifier {script}: {e}", file=sys.stderr)
-        return 8
+
+    message = None
+    if flap:
+        # The flap alert replaces the notification of this run
+        with open(run_file, 'r', errors='replace') as f:
+            output = f.read()
+        if flap[0] == 'start':
+            message = (f"FLAPPING START - {check_id} changed its state in {flap[1]:.1f}% of its "
+                       f"recent runs, notifications are suppressed until it is stable\n{output}")
+        else:
+            message = (f"FLAPPING STOP - {check_id} changed its state in {flap[1]:.1f}% of its "
+                       f"recent runs, notifications resume\n{output}")
+        print(message.split('\n', 1)[0])
+
+    plugins, scripts = find_notifiers()
+    if not plugins and not scripts:
+        print("No notifiers found")
+        checkerlib.record_stages(check_id, run_file, stages)
+        return 0
+
+    # Run notifiers in parallel
+    started = time.monotonic()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = asyncio.run(run_notifiers(plugins, scripts, hostname, check_id, exit_code,
+                                       run_file, env, stages, message))
+    stages['notifiers'] = {'wall_seconds': round(time.monotonic() - started, 6), 'exit_code': result}
+    if _standalone:
+        # Children of the scheduler process also include checks of other threads
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stages['notifiers']['cpu_seconds'] = round(
+            usage.ru_utime + usage.ru_stime - children.ru_utime - children.ru_stime, 6)
+    checkerlib.record_stages(check_id, run_file, stages)
+    return result
 
 
 def main():
+    global _standalone
+    _standalone = True
+
     # Get input parameters
     if len(sys.argv) < 4:
         print("Usage: notify.py <hostname> <check_id> <run_file>", file=sys.stderr)
         sys.exit(1)
-        
+
     hostname = sys.argv[1]
     check_id = sys.argv[2]
     run_file = sys.argv[3]
     exit_code = os.environ.get('EXIT_STATUS', '0')
-    
-    # Read the run file content
-    try:
-        with open(run_file, 'r') as f:
-            run_file_content = f.read()
-    except IOError as e:
-        print(f"Error reading run file: {e}", file=sys.stderr)
-        sys.exit(1)
-    
-    # Find all executable notifier scripts
-    notifier_scripts = []
-    for script in glob.glob('/etc/checker/notifiers/*.sh'):
-        if os.path.isfile(script) and os.access(script, os.X_OK):
-            notifier_scripts.append(script)
-    
-    if not notifier_scripts:
-        print("No executable notifier scripts found")
-        sys.exit(0)
-    
-    # Run notifiers in parallel
-    failed = 0
-    with ProcessPoolExecutor() as executor:
-        futures = {
-            executor.submit(run_notifier, script, hostname, check_id, exit_code, run_file_content): script
-            for script in notifier_scripts
-        }
-        
-        for future in as_completed(futures):
-            result = future.result()
-            if result != 0:
-                failed = result
-    
-    sys.exit(failed)
+
+    sys.exit(dispatch(hostname, check_id, exit_code, run_file))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
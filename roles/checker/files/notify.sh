@@ -6,11 +6,23 @@ check_id="$2"
 run_file="$3"
 exit_code="${EXIT_STATUS}"
 
+# Checks deferred by admission control have no new result
+if [ "$exit_code" = "75" ]; then
+    echo "Check $check_id was deferred, not notifying"
+    exit 0
+fi
+
+# Checks behind a CRITICAL parent are covered by the notification of the parent
+if [ "$exit_code" = "76" ]; then
+    echo "Check $check_id is unreachable, not notifying"
+    exit 0
+fi
+
 failed=0
 pids=""
 
 # Run each notifier script in parallel
-for script in /etc/checker/notifiers/*.sh; do
+for script in "${CHECKER_NOTIFIERS_DIR:-/etc/checker/notifiers}"/*.sh; do
     if [ -x "$script" ]; then
         echo "Notifying with $script"
         cat "$run_file" | "$script" "$hostname" "$check_id" "$exit_code" & 
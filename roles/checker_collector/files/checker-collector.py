@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+"""Collect check results pushed by checker-push.py from many hosts.
+
+Keeps the current result of every check on every host in memory, indexed by
+severity and by check, and answers fleet queries over HTTP:
+
+    POST /api/push                      Results of one host (checker-push.py)
+    GET  /api/results?severity=critical All results, filtered by severity,
+         &event=<check>&resource=<host>  check, host and environment
+         &environment=<environment>
+    GET  /api/hosts                     Hosts with last push and severity counts
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import signal
+import socket
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LISTEN_ADDRESS = os.environ.get('CHECKER_COLLECTOR_ADDRESS', '')
+LISTEN_PORT = int(os.environ.get('CHECKER_COLLECTOR_PORT', '9470'))
+API_KEY = os.environ.get('CHECKER_COLLECTOR_KEY', '')
+# Pending connections the kernel queues, all hosts may push at the same time
+LISTEN_BACKLOG = int(os.environ.get('CHECKER_COLLECTOR_BACKLOG', socket.SOMAXCONN))
+# Hosts that did not push for this many seconds are reported as stale
+STALE_AFTER = float(os.environ.get('CHECKER_COLLECTOR_STALE', '300'))
+
+# Largest accepted push, after decompression
+PUSH_SIZE_MAX = 16 * 1024 * 1024
+
+RESULT_FIELDS = ('severity', 'value', 'timestamp', 'duration', 'text', 'perfdata')
+
+
+class PushTooLarge(ValueError):
+    pass
+
+
+def decode_push(body, encoding):
+    """Decompress and parse a push, never inflating more than PUSH_SIZE_MAX bytes."""
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(wbits=31)
+        body = decompressor.decompress(body, PUSH_SIZE_MAX + 1)
+        if len(body) > PUSH_SIZE_MAX:
+            raise PushTooLarge(f"Push larger than {PUSH_SIZE_MAX} bytes")
+        if not decompressor.eof:
+            raise ValueError("Truncated gzip data")
+    elif encoding not in (None, 'identity'):
+        raise ValueError(f"Unsupported Content-Encoding {encoding}")
+    elif len(body) > PUSH_SIZE_MAX:
+        raise PushTooLarge(f"Push larger than {PUSH_SIZE_MAX} bytes")
+    return validate_push(json.loads(body))
+
+
+def validate_push(push):
+    """Check the structure of a whole push, so it is never applied halfway."""
+    if not isinstance(push, dict):
+        raise ValueError("Push is no object")
+    if not isinstance(push.get('resource'), str) or not push['resource']:
+        raise ValueError("Missing resource")
+    if not isinstance(push.get('session'), str):
+        raise ValueError("Missing session")
+    if not isinstance(push.get('seq'), int) or isinstance(push['seq'], bool):
+        raise ValueError("Missing seq")
+    if not isinstance(push.get('environment'), (str, type(None))):
+        raise ValueError("Invalid environment")
+    removed = push.get('removed', [])
+    if not isinstance(removed, list) or not all(isinstance(event, str) for event in removed):
+        raise ValueError("Invalid removed list")
+    results = push.get('results', [])
+    if not isinstance(results, list):
+        raise ValueError("Invalid results list")
+    for result in results:
+        if not isinstance(result, dict) or not isinstance(result.get('event'), str) \
+                or not isinstance(result.get('severity'), str):
+            raise ValueError("Invalid result")
+    return push
+
+
+class FleetIndex:
+    """Current results of all hosts with indexes by severity and check."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+        # severity -> {(resource, event)}, event -> {resource}
+        self.by_severity = {}
+        self.by_event = {}
+
+    def _remove(self, resource, event):
+        result = self.hosts[resource]['results'].pop(event, None)
+        if result is None:
+            return
+        self.by_severity[result['severity']].discard((resource, event))
+        self.by_event[event].discard(resource)
+        if not self.by_event[event]:
+            del self.by_event[event]
+
+    def _store(self, resource, event, result):
+        self._remove(resource, event)
+        self.hosts[resource]['results'][event] = result
+        self.by_severity.setdefault(result['severity'], set()).add((resource, event))
+        self.by_event.setdefault(event, set()).add(resource)
+
+    def apply(self, push):
+        """Apply a validated push of one host, returns False if it needs a full push.
+
+        Deltas are applied in order within a session; the last push may be
+        repeated, as a host resends it when the answer got lost. Results are
+        absolute, so applying one twice does no harm.
+        """
+        resource = push['resource']
+        with self.lock:
+            host = self.hosts.get(resource)
+            if not push.get('full'):
+                if host is None or host['session'] != push['session'] \
+                        or push['seq'] not in (host['seq'], host['seq'] + 1):
+                    return False
+            if host is None:
+                host = self.hosts[resource] = {'results': {}}
+            if push.get('full'):
+                for event in list(host['results']):
+                    self._remove(resource, event)
+            for event in push.get('removed', ()):
+                self._remove(resource, event)
+            for result in push.get('results', ()):
+                self._store(resource, result['event'],
+                            {key: result.get(key) for key in RESULT_FIELDS})
+            host.update(session=push['session'], seq=push['seq'],
+                        environment=push.get('environment'), last_seen=time.time())
+            return True
+
+    def results(self, severity=None, event=None, resource=None, environment=None):
+        """Results matching all given filters, starting from the smallest index."""
+        with self.lock:
+            candidates = []
+            if severity is not None:
+                candidates.append(self.by_severity.get(severity, set()))
+            if event is not None:
+                candidates.append({(host, event) for host in self.by_event.get(event, ())})
+            if resource is not None:
+                candidates.append({(resource, name) for name in
+                                   self.hosts.get(resource, {}).get('results', ())})
+            if candidates:
+                keys = set.intersection(*sorted(candidates, key=len))
+            else:
+                keys = {(host, name) for host, data in self.hosts.items() for name in data['results']}
+
+            results = []
+            for host, name in sorted(keys):
+                data = self.hosts[host]
+                if environment is not None and data['environment'] != environment:
+                    continue
+                results.append(dict(data['results'][name], resource=host, event=name,
+                                    environment=data['environment']))
+            return results
+
+    def host_list(self):
+        """All hosts with their last push and number of results per severity."""
+        now = time.time()
+        with self.lock:
+            hosts = []
+            for resource, data in sorted(self.hosts.items()):
+                counts = {}
+                for result in data['results'].values():
+                    counts[result['severity']] = counts.get(result['severity'], 0) + 1
+                hosts.append({
+                    'resource': resource,
+                    'environment': data['environment'],
+                    'lastSeen': data['last_seen'],
+                    'stale': now - data['last_seen'] > STALE_AFTER,
+                    'severityCounts': counts,
+                })
+            return hosts
+
+
+def make_handler(index):
+    class CollectorHandler(BaseHTTPRequestHandler):
+        # Keep-alive connections of the push clients, with headers and body
+        # written separately Nagle would delay every answer by the ACK delay
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def authorized(self):
+            if API_KEY and self.headers.get('Authorization', '') != f"Key {API_KEY}":
+                # The request body is not read, so the connection can not be reused
+                self.close_connection = True
+                self.send_json(401, {'status': 'error', 'message': 'Invalid API key'})
+                return False
+            return True
+
+        def do_POST(self):
+            if not self.authorized():
+                return
+            if self.path.split('?')[0] != '/api/push':
+                self.close_connection = True
+                self.send_json(404, {'status': 'error', 'message': 'Not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            if not 0 <= length <= PUSH_SIZE_MAX:
+                # The body is not read, so the connection can not be reused
+                self.close_connection = True
+                self.send_json(413 if length > 0 else 400,
+                               {'status': 'error', 'message': 'Invalid push size'})
+                return
+            try:
+                push = decode_push(self.rfile.read(length), self.headers.get('Content-Encoding'))
+            except PushTooLarge as e:
+                self.send_json(413, {'status': 'error', 'message': str(e)})
+                return
+            except (ValueError, RecursionError, zlib.error) as e:
+                self.send_json(400, {'status': 'error', 'message': f"Invalid push: {e}"})
+                return
+            accepted = index.apply(push)
+            if not accepted:
+                self.send_json(409, {'status': 'error', 'message': 'Full push required'})
+                return
+            self.send_json(200, {'status': 'ok', 'seq': push['seq']})
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+            url = urllib.parse.urlsplit(self.path)
+            query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+            if url.path == '/api/results':
+                results = index.results(query.get('severity'), query.get('event'),
+                                        query.get('resource'), query.get('environment'))
+                self.send_json(200, {'status': 'ok', 'total': len(results), 'results': results})
+            elif url.path == '/api/hosts':
+                hosts = index.host_list()
+                self.send_json(200, {'status': 'ok', 'total': len(hosts), 'hosts': hosts})
+            else:
+                self.send_json(404, {'status': 'error', 'message': 'Not found'})
+
+        def log_message(self, format, *args):
+            pass
+
+    return CollectorHandler
+
+
+class CollectorServer(ThreadingHTTPServer):
+    """Threading HTTP server with a listen backlog sized for a fleet.
+
+    The default backlog of 5 makes hosts pushing at the same time wait for
+    SYN retransmits or get their connection reset.
+    """
+
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+def main():
+    index = FleetIndex()
+    server = CollectorServer((LISTEN_ADDRESS, LISTEN_PORT), make_handler(index))
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Collecting check results on {LISTEN_ADDRESS or '*'}:{LISTEN_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
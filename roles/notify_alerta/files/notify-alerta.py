@@ -4,21 +4,42 @@
 
 import os
 import sys
+import ssl
 import json
+import time
+import fcntl
+import queue
+import threading
+import http.client
+import urllib.parse
 import urllib.request
 import urllib.error
 
+# Shared helpers installed by the checker role
+sys.path.insert(0, os.environ.get("CHECKER_LIB_DIR", "/etc/checker"))
+import checkerlib
+
+
+CONFIG_FILE = "/etc/checker/notify_alerta.env"
+SPOOL_DIR = "/var/spool/checker/alerta"
+
+# Configuration cached by the plugin entry point, keyed by file mtime
+_config = (None, None)
+
 
 def load_config():
     """Load configuration from /etc/checker/notify_alerta.env."""
     config = {}
-    config_file = "/etc/checker/notify_alerta.env"
     
-    if not os.path.exists(config_file):
-        print(f"Error: {config_file} not found", file=sys.stderr)
-        sys.exit(1)
+    if not os.path.exists(CONFIG_FILE):
+        raise FileNotFoundError(f"{CONFIG_FILE} not found")
+    
+    # Parsed by checker.py compile, unless the file changed since
+    registry_config = checkerlib.registry_config(CONFIG_FILE)
+    if registry_config is not None:
+        return registry_config
     
-    with open(config_file, 'r') as f:
+    with open(CONFIG_FILE, 'r') as f:
         for line in f:
             line = line.strip()
             if line and not line.startswith('#') and '=' in line:
@@ -41,40 +62,55 @@ def map_severity(exit_code):
     return severity_map.get(exit_code, "debug")
 
 
-def send_to_alerta(config, hostname, check_id, exit_code, text):
-    """Send alert to Alerta."""
-    severity = map_severity(exit_code)
-    
-    # Build alert data
-    alert_data = {
+def build_alert(config, hostname, check_id, exit_code, text):
+    """Build the Alerta alert for a check result."""
+    return {
         "text": text,
         "resource": hostname,
         "event": check_id,
         "environment": config.get("ALERTA_ENVIRONMENT", "production"),
-        "severity": severity,
+        "severity": map_severity(exit_code),
         "value": exit_code,
         "service": [hostname],
         "origin": "checker",
         "type": "checkerCheck"
     }
-    
-    # Prepare request
+
+
+def build_headers(config):
+    """Build the request headers, with API key if configured."""
     headers = {
         "Content-Type": "application/json"
     }
     
-    # Add API key if configured
     api_key = config.get("ALERTA_API_KEY")
     if api_key:
         headers["Authorization"] = f"Key {api_key}"
+    return headers
+
+
+def ssl_context(config):
+    """SSL context honoring ALERTA_SSL_VERIFY."""
+    context = ssl.create_default_context()
+    if config.get("ALERTA_SSL_VERIFY", "true") != "true":
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def send_to_alerta(config, hostname, check_id, exit_code, text):
+    """Send alert to Alerta."""
+    alert_data = build_alert(config, hostname, check_id, exit_code, text)
     
     # Send request
     url = config["ALERTA_API_ALERT_URL"]
     data = json.dumps(alert_data).encode('utf-8')
+    timeout = float(config.get("ALERTA_TIMEOUT", "10"))
     
     try:
-        req = urllib.request.Request(url, data=data, headers=headers)
-        with urllib.request.urlopen(req) as response:
+        req = urllib.request.Request(url, data=data, headers=build_headers(config))
+        context = ssl_context(config) if url.startswith("https:") else None
+        with urllib.request.urlopen(req, timeout=timeout, context=context) as response:
             result = response.read().decode('utf-8')
             return True, result
     except urllib.error.HTTPError as e:
@@ -84,14 +120,180 @@ def send_to_alerta(config, hostname, check_id, exit_code, text):
         return False, str(e)
 
 
+def spool_alert(config, hostname, check_id, exit_code, text):
+    """Queue an alert in the spool, replacing a pending one for the same resource/event."""
+    spool_dir = config.get("ALERTA_SPOOL_DIR", SPOOL_DIR)
+    os.makedirs(spool_dir, exist_ok=True)
+    alert_data = build_alert(config, hostname, check_id, exit_code, text)
+    
+    name = urllib.parse.quote(f"{hostname}/{check_id}", safe='')
+    tmp_file = os.path.join(spool_dir, f".{name}.{os.getpid()}.{threading.get_ident()}")
+    with open(tmp_file, 'w') as f:
+        json.dump(alert_data, f)
+    os.replace(tmp_file, os.path.join(spool_dir, f"{name}.json"))
+
+
+class AlertaConnection:
+    """Keep-alive HTTP(S) connection to the Alerta API."""
+    
+    def __init__(self, config):
+        url = urllib.parse.urlsplit(config["ALERTA_API_ALERT_URL"])
+        self.path = url.path + (f"?{url.query}" if url.query else "")
+        self.headers = build_headers(config)
+        timeout = float(config.get("ALERTA_TIMEOUT", "10"))
+        if url.scheme == "https":
+            self.connection = http.client.HTTPSConnection(
+                url.hostname, url.port, timeout=timeout, context=ssl_context(config))
+        else:
+            self.connection = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+    
+    def post(self, body):
+        """Post one alert, reconnecting once if the server closed the connection."""
+        for attempt in (1, 2):
+            try:
+                self.connection.request("POST", self.path, body=body, headers=self.headers)
+                response = self.connection.getresponse()
+                return response.status, response.read().decode('utf-8', errors='replace')
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.connection.close()
+                if attempt == 2:
+                    raise
+    
+    def close(self):
+        self.connection.close()
+
+
+def flush_worker(config, pending, failed):
+    """Drain spooled alerts over one persistent connection."""
+    connection = AlertaConnection(config)
+    try:
+        while not failed.is_set():
+            try:
+                path = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with open(path, 'rb') as f:
+                    inode = os.fstat(f.fileno()).st_ino
+                    body = f.read()
+            except FileNotFoundError:
+                continue
+            
+            try:
+                status, result = connection.post(body)
+            except (OSError, http.client.HTTPException) as e:
+                print(f"Failed to send to Alerta: {e}", file=sys.stderr)
+                failed.set()
+                return
+            
+            if status >= 500 or status == 429:
+                # Server side trouble, keep the alert and back off
+                print(f"Failed to send to Alerta: HTTP {status}: {result}", file=sys.stderr)
+                failed.set()
+                return
+            if status >= 400:
+                # Retrying a rejected alert would never succeed
+                print(f"Alerta rejected {os.path.basename(path)}: HTTP {status}: {result}", file=sys.stderr)
+            
+            # Only remove the alert if it was not replaced by a newer one meanwhile
+            try:
+                if os.stat(path).st_ino == inode:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+    finally:
+        connection.close()
+
+
+def flush_spool(config, wait=True):
+    """Send all spooled alerts, backing off exponentially while Alerta fails."""
+    spool_dir = config.get("ALERTA_SPOOL_DIR", SPOOL_DIR)
+    os.makedirs(spool_dir, exist_ok=True)
+    
+    with open(os.path.join(spool_dir, ".lock"), 'w') as lock:
+        # Only a single flusher drains the spool at a time
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return True
+        
+        backoff_file = os.path.join(spool_dir, ".backoff")
+        try:
+            with open(backoff_file, 'r') as f:
+                backoff = json.load(f)
+        except (IOError, ValueError):
+            backoff = {"failures": 0, "next_attempt": 0}
+        if time.time() < backoff["next_attempt"]:
+            return False
+        
+        pending = queue.Queue()
+        for name in sorted(os.listdir(spool_dir)):
+            if name.endswith(".json"):
+                pending.put(os.path.join(spool_dir, name))
+        if pending.empty():
+            return True
+        
+        failed = threading.Event()
+        concurrency = int(config.get("ALERTA_FLUSH_CONCURRENCY", "4"))
+        workers = [
+            threading.Thread(target=flush_worker, args=(config, pending, failed))
+            for _ in range(min(concurrency, pending.qsize()))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        if failed.is_set():
+            failures = backoff["failures"] + 1
+            delay = min(float(config.get("ALERTA_BACKOFF_MIN", "5")) * 2 ** (failures - 1),
+                        float(config.get("ALERTA_BACKOFF_MAX", "600")))
+            backoff = {"failures": failures, "next_attempt": time.time() + delay}
+            print(f"Alerta unreachable, retrying spooled alerts in {delay:g}s", file=sys.stderr)
+        else:
+            backoff = {"failures": 0, "next_attempt": 0}
+        with open(backoff_file, 'w') as f:
+            json.dump(backoff, f)
+        return not failed.is_set()
+
+
+def notify(hostname, check_id, exit_code, output):
+    """Notifier plugin entry point, called in-process by notify.py."""
+    global _config
+    mtime = os.stat(CONFIG_FILE).st_mtime
+    if _config[0] != mtime:
+        _config = (mtime, load_config())
+    config = _config[1]
+    
+    if config.get("ALERTA_SPOOL", "false") == "true":
+        spool_alert(config, hostname, check_id, str(exit_code), output)
+        # Delivery problems are handled by the spool, not by the caller
+        flush_spool(config, wait=False)
+        return True
+    
+    success, result = send_to_alerta(config, hostname, check_id, str(exit_code), output)
+    if not success:
+        raise RuntimeError(f"Failed to send to Alerta: {result}")
+    print(result)
+    return True
+
+
 def main():
     """Main function."""
     # Load configuration
-    config = load_config()
+    try:
+        config = load_config()
+    except FileNotFoundError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    # Drain the spool, used by checker-alerta-flush.service
+    if sys.argv[1:] == ["--flush"]:
+        sys.exit(0 if flush_spool(config) else 1)
     
     # Parse arguments
     if len(sys.argv) < 4:
-        print("Usage: notify-alerta.py <hostname> <check_id> <exit_code>", file=sys.stderr)
+        print("Usage: notify-alerta.py <hostname> <check_id> <exit_code> | notify-alerta.py --flush", file=sys.stderr)
         sys.exit(1)
     
     hostname = sys.argv[1]
@@ -101,6 +303,11 @@ def main():
     # Read check output from stdin
     text = sys.stdin.read()
     
+    if config.get("ALERTA_SPOOL", "false") == "true":
+        spool_alert(config, hostname, check_id, exit_code, text)
+        flush_spool(config, wait=False)
+        sys.exit(0)
+    
     # Send to Alerta
     success, result = send_to_alerta(config, hostname, check_id, exit_code, text)
     
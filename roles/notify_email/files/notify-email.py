@@ -4,22 +4,38 @@
 
 import os
 import sys
+import json
 import time
+import fcntl
+import sqlite3
 import subprocess
 from datetime import datetime
-from pathlib import Path
+
+# Shared helpers installed by the checker role
+sys.path.insert(0, os.environ.get("CHECKER_LIB_DIR", "/etc/checker"))
+import checkerlib
+
+
+CONFIG_FILE = "/etc/checker/notify_email.env"
+DIGEST_DIR = "/var/spool/checker/email-digest"
+
+# Configuration cached by the plugin entry point, keyed by file mtime
+_config = (None, None)
 
 
 def load_config():
     """Load configuration from /etc/checker/notify_email.env."""
     config = {}
-    config_file = "/etc/checker/notify_email.env"
     
-    if not os.path.exists(config_file):
-        print(f"Error: {config_file} not found", file=sys.stderr)
-        sys.exit(1)
+    if not os.path.exists(CONFIG_FILE):
+        raise FileNotFoundError(f"{CONFIG_FILE} not found")
     
-    with open(config_file, 'r') as f:
+    # Parsed by checker.py compile, unless the file changed since
+    registry_config = checkerlib.registry_config(CONFIG_FILE)
+    if registry_config is not None:
+        return registry_config
+    
+    with open(CONFIG_FILE, 'r') as f:
         for line in f:
             line = line.strip()
             if line and not line.startswith('#') and '=' in line:
@@ -42,39 +58,24 @@ def get_status_name(status_code):
     return status_map.get(status_code, "UNKNOWN")
 
 
-def check_rate_limit(check_name, rate_limit, rate_window):
-    """Check if we're within rate limits."""
-    rate_dir = Path("/var/run/checker")
-    rate_dir.mkdir(parents=True, exist_ok=True)
-    rate_file = rate_dir / f"email_rate_{check_name}.txt"
-    
-    current_time = int(time.time())
-    timestamps = []
-    
-    # Read existing timestamps
-    if rate_file.exists():
-        with open(rate_file, 'r') as f:
-            for line in f:
-                try:
-                    timestamp = int(line.strip())
-                    # Keep only timestamps within the window
-                    if current_time - timestamp < int(rate_window):
-                        timestamps.append(timestamp)
-                except ValueError:
-                    continue
-    
-    # Check if we've exceeded the limit
-    if len(timestamps) >= int(rate_limit):
-        print(f"Rate limit exceeded for {check_name} ({len(timestamps)}/{rate_limit} emails in {rate_window}s)")
-        return False
-    
-    # Add current timestamp and save
-    timestamps.append(current_time)
-    with open(rate_file, 'w') as f:
-        for ts in timestamps:
-            f.write(f"{ts}\n")
-    
-    return True
+def check_rate_limit(config, hostname, check_name):
+    """Check if we're within rate limits, using the shared token buckets."""
+    rate_limit = config.get("NOTIFY_EMAIL_RATE_LIMIT", "5")
+    rate_window = config.get("NOTIFY_EMAIL_RATE_WINDOW", "3600")
+    buckets = [
+        (f"email:check:{check_name}", rate_limit, rate_window),
+        (f"email:host:{hostname}", config.get("NOTIFY_EMAIL_RATE_LIMIT_HOST", "0"), rate_window),
+        ("email:global", config.get("NOTIFY_EMAIL_RATE_LIMIT_GLOBAL", "0"), rate_window),
+    ]
+
+    try:
+        if checkerlib.rate_limit(buckets):
+            return True
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error checking rate limit, sending anyway: {e}", file=sys.stderr)
+        return True
+    print(f"Rate limit exceeded for {check_name} on {hostname}")
+    return False
 
 
 def truncate_output(output, include_output, max_lines):
@@ -113,18 +114,114 @@ def send_email(subject, body, from_addr, to_addr):
         return False
 
 
-def main():
-    """Main function."""
-    # Load configuration
-    config = load_config()
+def queue_digest(config, hostname, check_name, status, output):
+    """Queue an alert for the next digest email."""
+    digest_dir = config.get("NOTIFY_EMAIL_DIGEST_DIR", DIGEST_DIR)
+    os.makedirs(digest_dir, exist_ok=True)
     
-    # Get arguments
-    hostname = sys.argv[1] if len(sys.argv) > 1 else "unknown"
-    check_name = sys.argv[2] if len(sys.argv) > 2 else "unknown"
-    status = sys.argv[3] if len(sys.argv) > 3 else "3"
+    entry = {
+        "time": time.time(),
+        "host": hostname,
+        "check": check_name,
+        "status": status,
+        "output": output.strip().split('\n')[0][:200]
+    }
+    with open(os.path.join(digest_dir, "queue.jsonl"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(entry) + '\n')
+    print(f"Queued {check_name} ({get_status_name(status)}) for the email digest")
+
+
+def format_digest(config, hostname, entries):
+    """Format one digest email for a host, grouped by status and check."""
+    timestamp = lambda t: datetime.utcfromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S UTC")
     
-    # Read output from stdin
-    output = sys.stdin.read()
+    # Latest result and number of alerts per check
+    checks = {}
+    for entry in entries:
+        count = checks.get(entry["check"], (0, None))[0]
+        checks[entry["check"]] = (count + 1, entry)
+    
+    sections = []
+    for status in ("2", "1", "3", "0"):
+        rows = sorted(
+            (name, count, entry) for name, (count, entry) in checks.items()
+            if (entry["status"] if entry["status"] in ("0", "1", "2") else "3") == status
+        )
+        if not rows:
+            continue
+        title = f"{get_status_name(status)} ({len(rows)})"
+        lines = [title, "-" * len(title)]
+        for name, count, entry in rows:
+            lines.append(f"{name:<24} {count}x, last {timestamp(entry['time'])}")
+            if config.get("NOTIFY_EMAIL_INCLUDE_OUTPUT", "true") == "true" and entry["output"]:
+                lines.append(f"    {entry['output']}")
+        sections.append('\n'.join(lines))
+    
+    subject_prefix = config.get("NOTIFY_EMAIL_SUBJECT_PREFIX", "[Checker]")
+    subject = f"{subject_prefix} Digest: {len(entries)} alerts from {len(checks)} checks on {hostname}"
+    
+    sections_text = '\n\n'.join(sections)
+    body = f"""Monitoring Digest
+=================
+
+Host:      {hostname}
+Period:    {timestamp(entries[0]['time'])} - {timestamp(entries[-1]['time'])}
+Alerts:    {len(entries)} from {len(checks)} checks
+
+{sections_text}
+
+---
+This notification was generated by the checker monitoring system.
+To modify notification settings, update /etc/checker/notify_email.env"""
+    return subject, body
+
+
+def flush_digest(config, force=False):
+    """Send the queued alerts as one email per host once the digest window passed."""
+    digest_dir = config.get("NOTIFY_EMAIL_DIGEST_DIR", DIGEST_DIR)
+    queue_file = os.path.join(digest_dir, "queue.jsonl")
+    window = int(config.get("NOTIFY_EMAIL_DIGEST_WINDOW", "0"))
+    if not os.path.exists(queue_file):
+        return True
+    
+    with open(queue_file, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        entries = []
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        if not entries:
+            return True
+        if not force and time.time() - entries[0]["time"] < window:
+            return True
+        
+        hosts = {}
+        for entry in entries:
+            hosts.setdefault(entry["host"], []).append(entry)
+        
+        from_addr = config.get("NOTIFY_EMAIL_FROM", "checker@localhost")
+        to_addr = config.get("NOTIFY_EMAIL_TO", "root@localhost")
+        unsent = []
+        for hostname, host_entries in hosts.items():
+            subject, body = format_digest(config, hostname, host_entries)
+            if send_email(subject, body, from_addr, to_addr):
+                print(f"Email digest with {len(host_entries)} alerts sent to {to_addr} for {hostname}")
+            else:
+                unsent.extend(host_entries)
+        
+        # Keep what could not be sent for the next attempt
+        f.seek(0)
+        f.truncate()
+        for entry in unsent:
+            f.write(json.dumps(entry) + '\n')
+        return not unsent
+
+
+def send_notification(config, hostname, check_name, status, output):
+    """Send the notification email, returns False if sending failed."""
     timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
     
     # Get status name
@@ -132,15 +229,20 @@ def main():
     
     # Check if we should send notification for this status
     if status == "1" and config.get("NOTIFY_EMAIL_ON_WARNING", "true") != "true":
-        sys.exit(0)
+        return True
     elif status == "2" and config.get("NOTIFY_EMAIL_ON_CRITICAL", "true") != "true":
-        sys.exit(0)
+        return True
+    
+    # Collect everything but criticals into the digest if enabled
+    if int(config.get("NOTIFY_EMAIL_DIGEST_WINDOW", "0")) > 0:
+        bypass = status == "2" and config.get("NOTIFY_EMAIL_DIGEST_BYPASS_CRITICAL", "true") == "true"
+        if not bypass:
+            queue_digest(config, hostname, check_name, status, output)
+            return flush_digest(config)
     
     # Rate limiting check
-    rate_limit = config.get("NOTIFY_EMAIL_RATE_LIMIT", "5")
-    rate_window = config.get("NOTIFY_EMAIL_RATE_WINDOW", "3600")
-    if not check_rate_limit(check_name, rate_limit, rate_window):
-        sys.exit(0)
+    if not check_rate_limit(config, hostname, check_name):
+        return True
     
     # Prepare output
     include_output = config.get("NOTIFY_EMAIL_INCLUDE_OUTPUT", "true")
@@ -171,9 +273,44 @@ To modify notification settings, update /etc/checker/notify_email.env"""
     from_addr = config.get("NOTIFY_EMAIL_FROM", "checker@localhost")
     to_addr = config.get("NOTIFY_EMAIL_TO", "root@localhost")
     
-    if send_email(subject, body, from_addr, to_addr):
-        print(f"Email notification sent to {to_addr} for {check_name} ({status_name})")
-    else:
+    if not send_email(subject, body, from_addr, to_addr):
+        return False
+    print(f"Email notification sent to {to_addr} for {check_name} ({status_name})")
+    return True
+
+
+def notify(hostname, check_id, exit_code, output):
+    """Notifier plugin entry point, called in-process by notify.py."""
+    global _config
+    mtime = os.stat(CONFIG_FILE).st_mtime
+    if _config[0] != mtime:
+        _config = (mtime, load_config())
+    
+    return send_notification(_config[1], hostname, check_id, str(exit_code), output)
+
+
+def main():
+    """Main function."""
+    # Load configuration
+    try:
+        config = load_config()
+    except FileNotFoundError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    # Send the pending digest, used by checker-email-digest.service
+    if sys.argv[1:] == ["--flush-digest"]:
+        sys.exit(0 if flush_digest(config) else 1)
+    
+    # Get arguments
+    hostname = sys.argv[1] if len(sys.argv) > 1 else "unknown"
+    check_name = sys.argv[2] if len(sys.argv) > 2 else "unknown"
+    status = sys.argv[3] if len(sys.argv) > 3 else "3"
+    
+    # Read output from stdin
+    output = sys.stdin.read()
+    
+    if not send_notification(config, hostname, check_name, status, output):
         sys.exit(1)
 
 
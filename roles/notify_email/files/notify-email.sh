@@ -34,30 +34,34 @@ case "$STATUS" in
     2) [ "$NOTIFY_EMAIL_ON_CRITICAL" != "true" ] && exit 0 ;;
 esac
 
-# Rate limiting check
-RATE_FILE="/var/run/checker/email_rate_${CHECK_NAME}.txt"
-mkdir -p /var/run/checker
-CURRENT_TIME=$(date +%s)
-
-if [ -f "$RATE_FILE" ]; then
-    # Read timestamps and filter out old ones
-    NEW_TIMESTAMPS=""
-    COUNT=0
-    while read -r timestamp; do
-        if [ $((CURRENT_TIME - timestamp)) -lt "$NOTIFY_EMAIL_RATE_WINDOW" ]; then
-            NEW_TIMESTAMPS="${NEW_TIMESTAMPS}${timestamp}\n"
-            COUNT=$((COUNT + 1))
-        fi
-    done < "$RATE_FILE"
-    
-    if [ $COUNT -ge "$NOTIFY_EMAIL_RATE_LIMIT" ]; then
-        echo "Rate limit exceeded for $CHECK_NAME (${COUNT}/${NOTIFY_EMAIL_RATE_LIMIT} emails in ${NOTIFY_EMAIL_RATE_WINDOW}s)"
-        exit 0
-    fi
-    
-    echo -e "${NEW_TIMESTAMPS}${CURRENT_TIME}" > "$RATE_FILE"
-else
-    echo "$CURRENT_TIME" > "$RATE_FILE"
+# Rate limiting with the token buckets shared with notify-email.py
+set +e
+python3 - "$HOSTNAME" "$CHECK_NAME" "${NOTIFY_EMAIL_RATE_LIMIT:-5}" "${NOTIFY_EMAIL_RATE_WINDOW:-3600}" \
+    "${NOTIFY_EMAIL_RATE_LIMIT_HOST:-0}" "${NOTIFY_EMAIL_RATE_LIMIT_GLOBAL:-0}" <<'EOF'
+import os
+import sys
+
+sys.path.insert(0, os.environ.get("CHECKER_LIB_DIR", "/etc/checker"))
+import checkerlib
+
+hostname, check_name, limit, window, limit_host, limit_global = sys.argv[1:]
+try:
+    allowed = checkerlib.rate_limit([
+        (f"email:check:{check_name}", limit, window),
+        (f"email:host:{hostname}", limit_host, window),
+        ("email:global", limit_global, window),
+    ])
+except Exception as e:
+    print(f"Error checking rate limit: {e}", file=sys.stderr)
+    sys.exit(2)
+sys.exit(0 if allowed else 1)
+EOF
+RATE_STATUS=$?
+set -e
+
+if [ "$RATE_STATUS" -eq 1 ]; then
+    echo "Rate limit exceeded for $CHECK_NAME on $HOSTNAME"
+    exit 0
 fi
 
 # Truncate output if needed
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+"""Benchmark the check -> notify pipeline without systemd.
+
+Runs a synthetic check.sh through a check runner (checker.sh or checker.py)
+and the run file through a notification dispatcher (notify.sh or
+notify.py), the same way checker@.service runs ExecStart and ExecStopPost,
+and reports latency percentiles per stage, forks per run, peak RSS and
+throughput.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'roles', 'checker', 'files')
+
+
+def count_forks():
+    """Processes created on the host since boot, from /proc/stat."""
+    with open('/proc/stat', 'r') as f:
+        for line in f:
+            if line.startswith('processes '):
+                return int(line.split()[1])
+    return 0
+
+
+def command(path):
+    """Command running a script through its #! interpreter, the checkout has no exec bits."""
+    with open(path, 'r') as f:
+        shebang = f.readline()
+    return shebang[2:].split() + [path] if shebang.startswith('#!') else [path]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def setup(base, args):
+    """Create the check, notifier stubs and state directories."""
+    dirs = {name: os.path.join(base, name) for name in ('checks', 'run', 'notifiers', 'lib')}
+    for path in dirs.values():
+        os.makedirs(path)
+
+    check_dir = os.path.join(dirs['checks'], 'bench')
+    os.makedirs(check_dir)
+    with open(os.path.join(check_dir, 'output.txt'), 'w') as f:
+        line = 'x' * 79 + '\n'
+        f.write('BENCH OK - synthetic check|value=1;5;10;0;100\n')
+        f.write((line * (args.output_bytes // len(line) + 1))[:args.output_bytes])
+    with open(os.path.join(check_dir, 'check.sh'), 'w') as f:
+        f.write('#!/bin/sh\n\ncat output.txt\nexit "$BENCH_EXIT_CODE"\n')
+    os.chmod(os.path.join(check_dir, 'check.sh'), 0o755)
+    with open(os.path.join(check_dir, 'check.env'), 'w') as f:
+        f.write('CHECK_METRICS_RETENTION=1440\n')
+
+    for i in range(args.notifiers):
+        script = os.path.join(dirs['notifiers'], f"stub-{i}.sh")
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\n\ncat > /dev/null\n')
+        os.chmod(script, 0o755)
+    for i in range(args.plugins):
+        with open(os.path.join(dirs['notifiers'], f"stub-{i}.py"), 'w') as f:
+            f.write('def notify(hostname, check_id, exit_code, output):\n    return True\n')
+
+    # Every path the runners and dispatchers write to stays in base, and
+    # admission control is off so host pressure does not defer runs
+    env = dict(
+        os.environ,
+        PATH='/usr/local/bin:/usr/bin:/bin',
+        PYTHONDONTWRITEBYTECODE='1',
+        CHECKER_CONFIG_DIR=base,
+        CHECKER_RUN_DIR=dirs['run'],
+        CHECKER_CACHE_DIR=os.path.join(dirs['run'], 'cache'),
+        CHECKER_CHECKS_DIR=dirs['checks'],
+        CHECKER_NOTIFIERS_DIR=dirs['notifiers'],
+        CHECKER_REGISTRY=os.path.join(base, 'registry'),
+        CHECKER_STATE_DB=os.path.join(dirs['lib'], 'state.db'),
+        CHECKER_METRICS_DIR=os.path.join(dirs['lib'], 'metrics'),
+        CHECKER_HISTORY_DIR=os.path.join(dirs['lib'], 'history'),
+        CHECKER_LIB_DIR=FILES_DIR,
+        CHECKER_PRESSURE_CPU='0',
+        CHECKER_PRESSURE_MEMORY='0',
+        CHECKER_PRESSURE_IO='0',
+        CHECKER_MAX_RUNNING='0',
+        NOTIFY_CONCURRENCY=str(args.notify_concurrency),
+    )
+    return check_dir, dirs['run'], env
+
+
+def run_stage(command, cwd, env, stdin=subprocess.DEVNULL):
+    """Run one stage, returns wall time and peak RSS of its main process."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdin=stdin,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, wait_status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    return time.perf_counter() - start, rusage.ru_maxrss * 1024, process.returncode
+
+
+def run_pipeline(runner, notifier, check_dir, run_dir, env, index, exit_codes, concurrency):
+    """One check run followed by its notification, like checker@.service."""
+    # Parallel pipelines get run files of their own
+    check_id = f"bench-{index % concurrency}"
+    run_file = os.path.join(run_dir, f"{check_id}.out")
+    exit_code = exit_codes[index % len(exit_codes)]
+    stage_env = dict(env, BENCH_EXIT_CODE=str(exit_code))
+
+    check_time, check_rss, status = run_stage(runner + [run_file], check_dir, stage_env)
+    stage_env.update(EXIT_CODE='exited', EXIT_STATUS=str(status))
+    notify_time, notify_rss, _ = run_stage(notifier + ['bench-host', check_id, run_file],
+                                           check_dir, stage_env)
+    return check_time, notify_time, max(check_rss, notify_rss)
+
+
+def benchmark(runner, notifier, args):
+    base = tempfile.mkdtemp(prefix='checker-bench-')
+    try:
+        check_dir, run_dir, env = setup(base, args)
+        runner = command(os.path.join(FILES_DIR, runner))
+        notifier = command(os.path.join(FILES_DIR, notifier))
+        exit_codes = [int(code) for code in args.exit_codes.split(',')]
+
+        # Warm up caches and the state database outside of the measurement
+        for index in range(min(args.warmup, args.iterations)):
+            run_pipeline(runner, notifier, check_dir, run_dir, env, index, exit_codes, args.concurrency)
+
+        lock = threading.Lock()
+        samples = []
+
+        def iteration(index):
+            result = run_pipeline(runner, notifier, check_dir, run_dir, env, index,
+                                  exit_codes, args.concurrency)
+            with lock:
+                samples.append(result)
+
+        forks = count_forks()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(iteration, range(args.iterations)))
+        elapsed = time.perf_counter() - start
+        forks = count_forks() - forks
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    result = {
+        'runner': os.path.basename(runner[-1]),
+        'notifier': os.path.basename(notifier[-1]),
+        'iterations': args.iterations,
+        'throughput': args.iterations / elapsed,
+        'forks_per_run': forks / args.iterations,
+        'peak_rss': max(rss for _, _, rss in samples),
+    }
+    for stage, position in (('check', 0), ('notify', 1), ('total', None)):
+        values = [sample[0] + sample[1] if position is None else sample[position] for sample in samples]
+        for p in (50, 90, 99):
+            result[f"{stage}_p{p}"] = percentile(values, p) * 1000
+        result[f"{stage}_max"] = max(values) * 1000
+    return result
+
+
+def print_table(results):
+    columns = [
+        ('runner', 'RUNNER', 11), ('notifier', 'NOTIFIER', 10),
+        ('check_p50', 'CHECK P50', 9), ('check_p99', 'P99', 7),
+        ('notify_p50', 'NOTIFY P50', 10), ('notify_p99', 'P99', 7),
+        ('total_p90', 'TOTAL P90', 9), ('forks_per_run', 'FORKS', 6),
+        ('peak_rss', 'PEAK RSS', 9), ('throughput', 'RUNS/S', 7),
+    ]
+
+    def cell(value, width):
+        if isinstance(value, float):
+            return f"{value:>{width}.1f}"
+        if isinstance(value, int):
+            return f"{value // 1024:>{width - 1}}K"
+        return f"{value:<{width}}"
+
+    print(' '.join(f"{title:<{width}}" if index < 2 else f"{title:>{width}}"
+                   for index, (_, title, width) in enumerate(columns)))
+    for result in results:
+        print(' '.join(cell(result[key], width) for key, _, width in columns))
+    print("Latencies in milliseconds, forks counted host wide from /proc/stat")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runner', action='append', choices=['checker.sh', 'checker.py'],
+                        help="Check runner to benchmark, repeat to compare (default: both)")
+    parser.add_argument('--notify', action='append', choices=['notify.sh', 'notify.py'],
+                        help="Notification dispatcher to benchmark, repeat to compare (default: both)")
+    parser.add_argument('--iterations', type=int, default=50, help="Check runs per combination")
+    parser.add_argument('--warmup', type=int, default=3, help="Unmeasured runs before each benchmark")
+    parser.add_argument('--concurrency', type=int, default=1, help="Pipelines running at the same time")
+    parser.add_argument('--output-bytes', type=int, default=1024, help="Output size of the check")
+    parser.add_argument('--exit-codes', default='0', help="Exit codes the check cycles through, like 0,2")
+    parser.add_argument('--notifiers', type=int, default=2, help="Stub notifier scripts")
+    parser.add_argument('--plugins', type=int, default=0, help="Stub notifier plugins (notify.py only)")
+    parser.add_argument('--notify-concurrency', type=int, default=8, help="NOTIFY_CONCURRENCY of notify.py")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    results = []
+    for runner in args.runner or ['checker.sh', 'checker.py']:
+        for notifier in args.notify or ['notify.sh', 'notify.py']:
+            results.append(benchmark(runner, notifier, args))
+            if args.json:
+                print(json.dumps(results[-1]), flush=True)
+    if not args.json:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+"""Push results of simulated hosts to a checker collector.
+
+Every simulated host pushes its result table with the Pusher of
+checker-push.py, then changes the state of some checks per round and pushes
+the deltas. Reports push and query latencies of the collector.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import collections
+import argparse
+import http.client
+import importlib.util
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'roles', 'checker', 'files')
+sys.path.insert(0, FILES_DIR)
+spec = importlib.util.spec_from_file_location('checker_push', os.path.join(FILES_DIR, 'checker-push.py'))
+checker_push = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(checker_push)
+
+
+def make_result(exit_code):
+    return {
+        'severity': checker_push.SEVERITIES[exit_code],
+        'value': exit_code,
+        'timestamp': time.time(),
+        'duration': round(random.uniform(0.01, 2), 3),
+        'text': f"SIMULATED {checker_push.SEVERITIES[exit_code].upper()} - value {random.randint(0, 100)}",
+        'perfdata': {'value': [float(random.randint(0, 100)), '%']},
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:9470', help="Collector base URL")
+    parser.add_argument('--key', default='', help="API key of the collector")
+    parser.add_argument('--hosts', type=int, default=100, help="Simulated hosts")
+    parser.add_argument('--checks', type=int, default=50, help="Checks per host")
+    parser.add_argument('--rounds', type=int, default=5, help="Delta pushes per host")
+    parser.add_argument('--change', type=float, default=0.05, help="Share of checks changing per round")
+    parser.add_argument('--concurrency', type=int, default=16, help="Hosts pushing at the same time")
+    args = parser.parse_args()
+
+    def simulate(index):
+        connection = checker_push.CollectorConnection(f"{args.url}/api/push", args.key, 10)
+        pusher = checker_push.Pusher(connection, f"sim-{index:04d}", 'simulation')
+        results = {f"check-{n:03d}": make_result(0) for n in range(args.checks)}
+        latencies, errors = [], []
+        try:
+            for _ in range(args.rounds + 1):
+                start = time.perf_counter()
+                try:
+                    pusher.push(results, heartbeat=0)
+                    latencies.append(time.perf_counter() - start)
+                except (OSError, http.client.HTTPException, RuntimeError) as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+                    # Start the next push on a new connection
+                    connection.close()
+                for check_id in random.sample(sorted(results), int(args.checks * args.change)):
+                    results[check_id] = make_result(random.choice([0, 1, 2, 3]))
+        finally:
+            connection.close()
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        hosts = list(executor.map(simulate, range(args.hosts)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for host, _ in hosts for latency in host]
+    errors = [error for _, host in hosts for error in host]
+    print(f"{len(latencies)} pushes from {args.hosts} hosts in {elapsed:.2f}s, "
+          f"p50 {percentile(latencies, 50) * 1000:.1f}ms, p99 {percentile(latencies, 99) * 1000:.1f}ms, "
+          f"{len(errors)} failed")
+    for error, count in sorted(collections.Counter(errors).items(), key=lambda item: -item[1]):
+        print(f"  {count}x {error}", file=sys.stderr)
+
+    headers = {'Authorization': f"Key {args.key}"} if args.key else {}
+    for query in ('results?severity=critical', 'results?event=check-000', 'hosts'):
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(f"{args.url}/api/{query}", headers=headers)) as response:
+                total = json.load(response)['total']
+        except (OSError, ValueError, KeyError) as e:
+            errors.append(e)
+            print(f"GET /api/{query} failed: {e}", file=sys.stderr)
+            continue
+        print(f"GET /api/{query}: {total} entries in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
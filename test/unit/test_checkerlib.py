@@ -0,0 +1,208 @@
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the parsers and stores of checkerlib."""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'roles', 'checker', 'files')
+sys.path.insert(0, FILES_DIR)
+import checkerlib  # noqa: E402
+
+
+class TimespanTest(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual(checkerlib.timespan_seconds('30'), 30)
+        self.assertEqual(checkerlib.timespan_seconds('5min'), 300)
+        self.assertEqual(checkerlib.timespan_seconds('1h 30min'), 5400)
+        self.assertEqual(checkerlib.timespan_seconds('1.5h'), 5400)
+        self.assertEqual(checkerlib.timespan_seconds('2d'), 2 * 86400)
+        self.assertEqual(checkerlib.timespan_seconds('1w'), 7 * 86400)
+        self.assertAlmostEqual(checkerlib.timespan_seconds('100ms'), 0.1)
+        self.assertAlmostEqual(checkerlib.timespan_seconds('250us'), 0.00025)
+
+    def test_month_is_not_minute(self):
+        self.assertEqual(checkerlib.timespan_seconds('1m'), 60)
+        self.assertEqual(checkerlib.timespan_seconds('1M'), 30.44 * 86400)
+
+    def test_invalid(self):
+        for value in ('', 'abc', '5x', '1h x', '-5'):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                checkerlib.timespan_seconds(value)
+
+    def test_parse_timespan_default(self):
+        self.assertEqual(checkerlib.parse_timespan(None, 7), 7)
+        self.assertEqual(checkerlib.parse_timespan('  ', 7), 7)
+        self.assertEqual(checkerlib.parse_timespan('1h', 7), 3600)
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.assertEqual(checkerlib.parse_timespan('1 fortnight', 7), 7)
+        self.assertIn('Warning', stderr.getvalue())
+
+    def test_parse_number(self):
+        self.assertEqual(checkerlib.parse_number('1.5', 2), 1.5)
+        self.assertEqual(checkerlib.parse_number('3', 0, int), 3)
+        self.assertEqual(checkerlib.parse_number(None, 2), 2)
+        with contextlib.redirect_stderr(io.StringIO()):
+            for value in ('x', 'nan', 'inf', '-inf', '20%'):
+                with self.subTest(value=value):
+                    self.assertEqual(checkerlib.parse_number(value, 2), 2)
+            self.assertEqual(checkerlib.parse_number('3.5', 0, int), 0)
+
+
+class PerfdataTest(unittest.TestCase):
+
+    def test_first_line(self):
+        metrics = checkerlib.parse_perfdata("DISK OK|/=2643MB;5948;5958;0;5968 time=0.5s")
+        self.assertEqual(metrics, [
+            checkerlib.Metric('/', 2643.0, 'MB', '5948', '5958', 0.0, 5968.0),
+            checkerlib.Metric('time', 0.5, 's', None, None, None, None),
+        ])
+
+    def test_quoted_label(self):
+        metrics = checkerlib.parse_perfdata("OK|'free space'=10% 'it''s'=1")
+        self.assertEqual([(metric.label, metric.value) for metric in metrics],
+                         [('free space', 10.0), ("it's", 1.0)])
+
+    def test_long_output(self):
+        output = "OK - first|a=1\nlong output\nmore|b=2;@10:20;~:30\n"
+        metrics = checkerlib.parse_perfdata(output)
+        self.assertEqual([metric.label for metric in metrics], ['a', 'b'])
+        self.assertEqual((metrics[1].warn, metrics[1].crit), ('@10:20', '~:30'))
+
+    def test_skipped_values(self):
+        self.assertEqual(checkerlib.parse_perfdata("OK|a=U b=1,5"), [
+            checkerlib.Metric('b', 1.5, '', None, None, None, None),
+        ])
+        self.assertEqual(checkerlib.parse_perfdata("OK - no performance data"), [])
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'state.db')
+        self.now = 1000000.0
+        patcher = mock.patch.object(checkerlib.time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def take(self, *buckets):
+        return checkerlib.rate_limit(list(buckets), self.path)
+
+    def test_bucket_empties_and_refills(self):
+        bucket = ('check', '2', '3600')
+        self.assertTrue(self.take(bucket))
+        self.assertTrue(self.take(bucket))
+        self.assertFalse(self.take(bucket))
+        # One token per 1800 seconds
+        self.now += 1799
+        self.assertFalse(self.take(bucket))
+        self.now += 1
+        self.assertTrue(self.take(bucket))
+        self.assertFalse(self.take(bucket))
+
+    def test_unlimited(self):
+        for _ in range(10):
+            self.assertTrue(self.take(('check', '0', '3600')))
+
+    def test_empty_bucket_takes_no_tokens(self):
+        self.assertTrue(self.take(('global', '1', '3600')))
+        # The check bucket keeps its token while the global one is empty
+        self.assertFalse(self.take(('check', '1', '3600'), ('global', '1', '3600')))
+        self.assertTrue(self.take(('check', '1', '3600')))
+
+
+class MetricRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'check', 'value.ring')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_raw_ring_wraps(self):
+        ring = checkerlib.MetricRing(self.path, 3)
+        for i in range(5):
+            ring.add(100 + i, float(i))
+        self.assertEqual(ring.records(), [(102, 2.0), (103, 3.0), (104, 4.0)])
+        ring.close()
+
+        # Reopened with the same capacity the records are kept, with another one they are not
+        ring = checkerlib.MetricRing(self.path, 3)
+        self.assertEqual(len(ring.records()), 3)
+        ring.close()
+        ring = checkerlib.MetricRing(self.path, 4)
+        self.assertEqual(ring.records(), [])
+        ring.close()
+
+    def test_downsampled_ring(self):
+        ring = checkerlib.MetricRing(self.path, 2, step=60)
+        for timestamp, value in ((0, 1.0), (10, 3.0), (59, 2.0), (60, 10.0), (130, 5.0)):
+            ring.add(timestamp, value)
+        # Steps are closed by the first sample of the next one
+        self.assertEqual(ring.records(), [(0, 2.0, 1.0, 3.0), (60, 10.0, 10.0, 10.0)])
+        ring.close()
+
+
+class HistoryTest(unittest.TestCase):
+
+    DAY = checkerlib.History.SEGMENT_SECONDS
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.history = checkerlib.History(self.tmp.name)
+        self.start = 20000 * self.DAY
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_records_follow_the_chain_of_one_check(self):
+        for i, exit_code in enumerate((0, 2, 2, 0)):
+            self.history.append('a', self.start + 60 * i, 0.5, exit_code)
+            self.history.append('b', self.start + 60 * i + 1, 1.0, 0)
+        self.assertEqual([(end - self.start, exit_code) for end, _, exit_code, _
+                          in self.history.records('a')],
+                         [(0, 0), (60, 2), (120, 2), (180, 0)])
+        self.assertEqual(len(self.history.records('b', since=self.start + 100)), 2)
+        self.assertEqual(self.history.records('unknown'), [])
+
+    def test_summaries(self):
+        self.history.append('a', self.start, 1.0, 0)
+        self.history.append('a', self.start + 100, 3.0, 2)
+        self.history.append('a', self.start + 160, 2.0, 0)
+        summary = self.history.summaries()['a']
+        self.assertEqual((summary['runs'], summary['changes'], summary['exit_code']), (3, 2, 0))
+        self.assertEqual((summary['total_duration'], summary['max_duration']), (6.0, 3.0))
+        self.assertEqual(summary['max_end'], self.start + 100)
+        # 100 seconds OK until the CRITICAL run, then 60 seconds CRITICAL
+        self.assertEqual(summary['state_seconds'], [100.0, 0.0, 60.0, 0.0])
+
+    def test_day_rollover_continues_the_state(self):
+        self.history.append('a', self.start + self.DAY - 10, 1.0, 2)
+        self.history.append('a', self.start + self.DAY + 10, 1.0, 2)
+        summaries = self.history.summaries(since=self.start + self.DAY)
+        self.assertEqual(summaries['a']['changes'], 0)
+        self.assertEqual(summaries['a']['state_seconds'][2], 20.0)
+        self.assertEqual(len(self.history.records('a')), 2)
+
+    def test_recent_and_prune(self):
+        for day in range(3):
+            self.history.append('a', self.start + day * self.DAY, 1.0, day, retention_days=2)
+        self.assertEqual(len(self.history.days()), 2)
+        self.assertEqual([result[3] for result in self.history.recent(5)], [2, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
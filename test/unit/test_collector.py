@@ -0,0 +1,103 @@
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the push decoding and fleet index of checker-collector.py."""
+
+import os
+import gzip
+import json
+import unittest
+import importlib.util
+from unittest import mock
+
+COLLECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'roles', 'checker_collector',
+                         'files', 'checker-collector.py')
+spec = importlib.util.spec_from_file_location('checker_collector', COLLECTOR)
+collector = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(collector)
+
+
+def push(seq, results=(), removed=(), full=False, session='s1', resource='web1'):
+    return {
+        'resource': resource,
+        'environment': 'production',
+        'session': session,
+        'seq': seq,
+        'full': full,
+        'results': [{'event': event, 'severity': severity} for event, severity in results],
+        'removed': list(removed),
+    }
+
+
+class FleetIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = collector.FleetIndex()
+
+    def severities(self, **filters):
+        return {result['event']: result['severity'] for result in self.index.results(**filters)}
+
+    def test_delta_needs_a_full_push_first(self):
+        self.assertFalse(self.index.apply(push(1, [('disk', 'ok')])))
+        self.assertEqual(self.index.results(), [])
+
+    def test_deltas_in_order(self):
+        self.assertTrue(self.index.apply(push(1, [('disk', 'ok'), ('load', 'ok')], full=True)))
+        self.assertTrue(self.index.apply(push(2, [('disk', 'critical')])))
+        self.assertEqual(self.severities(), {'disk': 'critical', 'load': 'ok'})
+        self.assertEqual(self.severities(severity='critical'), {'disk': 'critical'})
+
+        # The last push may be repeated, a gap or another session needs a full push
+        self.assertTrue(self.index.apply(push(2, [('disk', 'critical')])))
+        self.assertFalse(self.index.apply(push(4, [('load', 'warning')])))
+        self.assertFalse(self.index.apply(push(3, [('load', 'warning')], session='s2')))
+        self.assertEqual(self.severities(), {'disk': 'critical', 'load': 'ok'})
+
+    def test_removed_and_full_push(self):
+        self.index.apply(push(1, [('disk', 'ok'), ('load', 'ok')], full=True))
+        self.index.apply(push(2, removed=['load']))
+        self.assertEqual(self.severities(), {'disk': 'ok'})
+        self.assertEqual(self.index.results(event='load'), [])
+
+        # A full push replaces all results of the host, also in a new session
+        self.index.apply(push(1, [('mem', 'warning')], full=True, session='s2'))
+        self.assertEqual(self.severities(), {'mem': 'warning'})
+        self.assertEqual(self.index.results(severity='ok'), [])
+
+    def test_filters(self):
+        self.index.apply(push(1, [('disk', 'ok')], full=True))
+        self.index.apply(push(1, [('disk', 'critical')], full=True, resource='db1'))
+        self.assertEqual([result['resource'] for result in self.index.results(event='disk')], ['db1', 'web1'])
+        self.assertEqual(len(self.index.results(resource='db1', severity='ok')), 0)
+        self.assertEqual(len(self.index.results(environment='staging')), 0)
+
+
+class DecodePushTest(unittest.TestCase):
+
+    def test_gzip(self):
+        body = gzip.compress(json.dumps(push(1, [('disk', 'ok')], full=True)).encode())
+        self.assertEqual(collector.decode_push(body, 'gzip')['resource'], 'web1')
+        self.assertEqual(collector.decode_push(json.dumps(push(1)).encode(), None)['seq'], 1)
+
+    def test_size_limit(self):
+        body = gzip.compress(b' ' * 2048 + json.dumps(push(1)).encode())
+        with mock.patch.object(collector, 'PUSH_SIZE_MAX', 1024):
+            with self.assertRaises(collector.PushTooLarge):
+                collector.decode_push(body, 'gzip')
+            with self.assertRaises(collector.PushTooLarge):
+                collector.decode_push(b' ' * 2048, None)
+
+    def test_invalid(self):
+        body = gzip.compress(json.dumps(push(1)).encode())
+        with self.assertRaises(ValueError):
+            collector.decode_push(body[:-8], 'gzip')
+        with self.assertRaises(ValueError):
+            collector.decode_push(body, 'br')
+        for invalid in ([], dict(push(1), seq='1'), dict(push(1), seq=True), dict(push(1), resource=''),
+                        dict(push(1), removed=[1]), dict(push(1), results=[{'event': 'disk'}])):
+            with self.subTest(push=invalid), self.assertRaises(ValueError):
+                collector.validate_push(invalid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# SPDX-FileCopyrightText: 2024 Markus Katharina Brechtel <markus.katharina.brechtel@thengo.net>
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the state and flap detection of notify.py."""
+
+import os
+import sys
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'roles', 'checker', 'files')
+sys.path.insert(0, FILES_DIR)
+spec = importlib.util.spec_from_file_location('notify', os.path.join(FILES_DIR, 'notify.py'))
+notify = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(notify)
+
+
+class StateChangePercentTest(unittest.TestCase):
+
+    def test_bounds(self):
+        self.assertEqual(notify.state_change_percent(0, 21), 0)
+        self.assertAlmostEqual(notify.state_change_percent((1 << 20) - 1, 21), 100)
+
+    def test_recent_changes_weigh_more(self):
+        newest = notify.state_change_percent(1, 21)
+        oldest = notify.state_change_percent(1 << 19, 21)
+        self.assertAlmostEqual(newest, 100 * 1.2 / 20)
+        self.assertAlmostEqual(oldest, 100 * 0.8 / 20)
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(notify.checkerlib, 'STATE_DB', os.path.join(self.tmp.name, 'state.db'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 1000000.0
+        patcher = mock.patch.object(notify.time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def update(self, exit_code, **env):
+        notify_, flap = notify.update_state('check', exit_code, env)
+        return notify_, flap and flap[0]
+
+    def test_new_check(self):
+        self.assertEqual(self.update(0), (True, None))
+        self.assertEqual(self.update(0), (True, None))
+
+    def test_change_only_and_renotify(self):
+        env = {'NOTIFY_ON_CHANGE_ONLY': 'true', 'NOTIFY_RENOTIFY_INTERVAL': '1h'}
+        self.assertEqual(self.update(0, **env), (False, None))
+        self.assertEqual(self.update(2, **env), (True, None))
+        self.now += 1800
+        self.assertEqual(self.update(2, **env), (False, None))
+        self.now += 1800
+        self.assertEqual(self.update(2, **env), (True, None))
+        self.assertEqual(self.update(0, **env), (True, None))
+
+    def test_flap_detection_is_opt_in(self):
+        for exit_code in (0, 2) * 10:
+            self.assertEqual(self.update(exit_code), (True, None))
+
+    def test_flapping_starts_and_stops(self):
+        env = {'NOTIFY_FLAP_DETECTION': 'true', 'NOTIFY_FLAP_HISTORY': '11',
+               'NOTIFY_FLAP_LOW': '20', 'NOTIFY_FLAP_HIGH': '30'}
+        events = [self.update(exit_code, **env) for exit_code in (0, 2, 0, 2, 0, 2)]
+        # Three recent changes out of ten weigh about 35%, above the high threshold
+        self.assertEqual(events, [(True, None)] * 3 + [(True, 'start')] + [(False, None)] * 2)
+
+        events = [self.update(2, **env) for _ in range(10)]
+        self.assertIn((True, 'stop'), events)
+        stop = events.index((True, 'stop'))
+        self.assertEqual(events[:stop], [(False, None)] * stop)
+        self.assertEqual(events[stop + 1:], [(True, None)] * (len(events) - stop - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()